@@ -1,3 +1,5 @@
+import time
+import_start = time.perf_counter() # 开始导入模块的时间，用于--timing统计导入耗时
 from .boot import Boot
 
 __author__ = "shigebeyond"
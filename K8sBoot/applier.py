@@ -0,0 +1,166 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pyutilb.log import log
+
+# 资源类型(kind)对应的批次：先应用被依赖的资源，删除时倒序
+kind_waves = [
+    ['Namespace', 'PersistentVolume'],
+    ['ConfigMap', 'Secret', 'PersistentVolumeClaim'],
+    ['Pod', 'ReplicationController', 'ReplicaSet', 'DaemonSet', 'StatefulSet', 'Deployment', 'Job', 'CronJob'],
+    ['Service', 'Ingress', 'HorizontalPodAutoscaler', 'PodDisruptionBudget'],
+]
+
+# 获得资源的批次序号，未知类型放到最后一个批次
+def get_kind_wave(kind):
+    for i, kinds in enumerate(kind_waves):
+        if kind in kinds:
+            return i
+    return len(kind_waves) - 1
+
+'''
+批量任务: 按标签选择器处理一组资源(如deletecollection)，与单个资源yaml一样交给应用器分批次执行
+'''
+class CollectionTask(object):
+
+    def __init__(self, api_version, kind, namespace, selector):
+        '''
+        :param api_version 资源的apiVersion
+        :param kind 资源kind
+        :param namespace 命名空间
+        :param selector 标签选择器
+        '''
+        self.api_version = api_version
+        self.kind = kind
+        self.namespace = namespace
+        self.selector = selector
+
+    def __str__(self):
+        return f"{self.kind}[{self.namespace}: {self.selector}]"
+
+# 获得资源或批量任务的kind
+def get_yaml_kind(yml):
+    if isinstance(yml, CollectionTask):
+        return yml.kind
+    return yml.get('kind')
+
+# 资源的简称，用于日志
+def get_yaml_label(yml):
+    if isinstance(yml, CollectionTask):
+        return str(yml)
+    meta = yml.get('metadata') or {}
+    name = meta.get('name') or meta.get('generateName')
+    ns = meta.get('namespace')
+    if ns:
+        name = ns + '/' + name
+    return f"{yml.get('kind')}[{name}]"
+
+'''
+单个批次的执行报告
+'''
+class WaveReport(object):
+
+    def __init__(self, wave):
+        self.wave = wave # 批次序号
+        self.costs = [] # 每个资源的耗时(秒)
+        self.failures = [] # 失败的资源: [(资源简称, 异常)]
+
+    # 记录单个资源的执行结果
+    def add(self, label, cost, ex=None):
+        self.costs.append(cost)
+        if ex is not None:
+            self.failures.append((label, ex))
+
+    # 总数
+    @property
+    def total(self):
+        return len(self.costs)
+
+    def __str__(self):
+        if not self.costs:
+            return f"批次{self.wave}: 无资源"
+        avg = sum(self.costs) / len(self.costs)
+        return f"批次{self.wave}: 资源数={self.total}, 失败数={len(self.failures)}, 耗时(秒) min={min(self.costs):.3f} avg={avg:.3f} max={max(self.costs):.3f}"
+
+'''
+并发的k8s资源应用器
+    按依赖关系将资源分批次(wave): Namespace -> ConfigMap/Secret/PVC -> 工作负载 -> Service/Ingress/HPA，删除时倒序
+    批次之间串行，同一批次内的资源互不依赖，用线程池并发调用api
+'''
+class Applier(object):
+
+    def __init__(self, workers = None, name = None, abort = None):
+        '''
+        :param workers 并发调用api的线程数，默认10
+        :param name 名称，作为日志前缀，如多集群执行时为集群上下文，以便在日志中区分
+        :param abort 中止事件(threading.Event)，被设置则不再执行后续批次，如多集群应用的fail-fast
+        '''
+        self.workers = int(workers or 10)
+        self.name = name
+        self.abort = abort
+
+    def group_waves(self, ymls, reverse = False):
+        '''
+        将资源按类型分批次
+        :param ymls 资源列表，元素是(资源类型, 资源yaml或批量任务)
+        :param reverse 是否倒序，用于删除
+        :return 批次列表，元素是(批次序号, 资源列表)
+        '''
+        waves = {}
+        for type, yml in ymls:
+            i = get_kind_wave(get_yaml_kind(yml))
+            waves.setdefault(i, []).append((type, yml))
+        return sorted(waves.items(), reverse=reverse)
+
+    def run(self, ymls, func, action = 'apply', reverse = False):
+        '''
+        分批次并发处理资源
+        :param ymls 资源列表，元素是(资源类型, 资源yaml或批量任务)
+        :param func 处理单个资源的函数，参数为(资源类型, 资源yaml或批量任务)
+        :param action 动作名，用于日志
+        :param reverse 是否倒序，用于删除
+        :return 每个批次的报告
+        '''
+        reports = []
+        if self.name:
+            action = f"集群[{self.name}] {action}"
+        with ThreadPoolExecutor(self.workers) as pool:
+            for i, wave in self.group_waves(ymls, reverse):
+                if self.abort is not None and self.abort.is_set():
+                    raise Exception(f"{action}已中止: 批次{i}及后续批次未执行")
+                report = self.run_wave(pool, i, wave, func)
+                reports.append(report)
+                log.info(f"{action} %s", report)
+                # 当前批次有失败，则后续批次(依赖当前批次)不再执行
+                if report.failures:
+                    for label, ex in report.failures:
+                        log.error(f"{action}资源%s失败: %s", label, ex)
+                    raise Exception(f"{action}资源失败: 批次{i}中有{len(report.failures)}个资源失败, 已终止后续批次")
+        return reports
+
+    def run_wave(self, pool, i, wave, func):
+        '''
+        并发处理单个批次的资源
+        :param pool 线程池
+        :param i 批次序号
+        :param wave 资源列表，元素是(资源类型, 资源yaml)
+        :param func 处理单个资源的函数
+        '''
+        report = WaveReport(i)
+        futures = {pool.submit(self.run_1yaml, func, type, yml): yml for type, yml in wave}
+        for future in as_completed(futures):
+            cost, ex = future.result()
+            report.add(get_yaml_label(futures[future]), cost, ex)
+        return report
+
+    # 处理单个资源，返回耗时与异常
+    def run_1yaml(self, func, type, yml):
+        start = time.time()
+        try:
+            func(type, yml)
+            ex = None
+        except Exception as e:
+            ex = e
+        return time.time() - start, ex
@@ -1,11 +1,16 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import copy
 import fnmatch
 import hashlib
 import json
 import os
 import re
+import sys
+import time
+import argparse
+from functools import wraps
 from itertools import groupby
 from urllib import parse
 from pyutilb.util import *
@@ -13,8 +18,13 @@ from pyutilb.file import *
 from pyutilb.cmd import *
 from pyutilb import YamlBoot, BreakException
 from pyutilb.log import log
-from dotenv import dotenv_values
-from kubernetes import client, config
+from K8sBoot.applier import Applier, CollectionTask
+from K8sBoot.differ import diff_object, format_value
+from K8sBoot.manifest import Manifest, build_fingerprint, get_render_version
+from K8sBoot.metrics import RunMetrics
+from K8sBoot.output_index import OutputIndex, get_yaml_type
+from K8sBoot.timing import Timing
+from K8sBoot.yaml_io import load_yaml_file, write_yaml_file
 
 '''
 k8s配置生成的基于yaml的启动器
@@ -32,7 +42,44 @@ class Boot(YamlBoot):
         'deploy': 'Deployment',
     }
 
-    def __init__(self, output_dir):
+    # 记录资源内容hash的注解名，用于apply时跳过未变更的资源
+    hash_annotation = 'k8sboot/hash'
+    # 管理者标签: 每个渲染的资源都有，用于--prune找出过期资源、delete时按标签批量删除
+    managed_by_label = 'app.kubernetes.io/managed-by'
+    managed_by = 'K8sBoot'
+    # 代次标签: 资源最后一次被哪次执行创建/更新，只在应用到集群时打上，不写到资源文件中
+    generation_label = 'k8sboot/generation'
+    # 节点注解: 记录K8sBoot设置过的节点标签名，以便配置中去掉的标签能被删除，而不动其他来源的标签(如kubelet设置的)
+    node_labels_annotation = 'k8sboot/node-labels'
+    # --prune要检查的资源类型(命名空间级)，另外加上本次渲染出的类型
+    prune_kinds = [
+        ('v1', 'ConfigMap'),
+        ('v1', 'Secret'),
+        ('v1', 'PersistentVolumeClaim'),
+        ('v1', 'Pod'),
+        ('v1', 'ReplicationController'),
+        ('v1', 'Service'),
+        ('apps/v1', 'ReplicaSet'),
+        ('apps/v1', 'DaemonSet'),
+        ('apps/v1', 'StatefulSet'),
+        ('apps/v1', 'Deployment'),
+        ('batch/v1', 'Job'),
+        ('batch/v1', 'CronJob'),
+        ('networking.k8s.io/v1', 'Ingress'),
+        ('autoscaling/v2', 'HorizontalPodAutoscaler'),
+        ('policy/v1', 'PodDisruptionBudget'),
+    ]
+
+    def __init__(self, output_dir, workers = None, incremental = False, manifest_dir = None, write_output = True):
+        '''
+        :param output_dir 输出目录
+        :param workers 应用k8s资源时并发调用api的线程数
+        :param incremental 是否增量渲染: 跳过输入未变更的app
+        :param manifest_dir 增量渲染的清单所在目录，默认为输出目录，并行渲染时子进程输出到临时目录，但要读主输出目录的清单
+        :param write_output 是否将资源写到输出目录，直接应用到集群时可以不写
+        '''
+        if incremental and not write_output:
+            raise Exception('增量渲染依赖输出目录中的资源文件, 不能与不写资源文件同时使用')
         super().__init__()
         self.output_dir = os.path.abspath(output_dir or 'out')
         # step_dir作为当前目录
@@ -44,6 +91,8 @@ class Boot(YamlBoot):
             'ns': self.ns,
             'app': self.app,
             'labels': self.labels,
+            'depends_on': self.depends_on,
+            'node_labels': self.node_labels,
             'config': self.config,
             'config_from_files': self.config_from_files,
             'secret': self.secret,
@@ -74,6 +123,32 @@ class Boot(YamlBoot):
         self._ns = '' # 命名空间
         self.app2ports = {} # 记录每个app的容器端口映射，不会清空
         self.app2port2service = {} # 记录每个app的端口对服务名映射，不会清空
+        self.app2deps = {} # 记录每个app依赖的其他app，不会清空，用于应用到集群时按依赖分层
+        self.node2labels = {} # 记录节点(或节点名通配符)的标签，不会清空，用于应用到集群时修正节点标签
+        self._written_files = set() # 记录本次生成的资源文件名，不会清空
+        self._rendered_apps = [] # 记录本次渲染(含增量渲染跳过)的app，不会清空
+        self._foreign_refs = set() # 记录引用过的、非本次渲染的app，不会清空，用于并行渲染时判断是否依赖其他步骤文件
+        self._ns_imported = False # 命名空间是否从其他步骤文件导入的，用于并行渲染
+        self.file_stat = {'written': 0, 'unchanged': 0} # 统计本次写入与未变更的资源文件数
+        self._output_dir_created = False # 是否已创建输出目录
+        self.write_output = write_output # 是否写资源文件
+        self._file2objects = {} # 记录本次渲染的资源，key是文件名，value是[(资源类型, 资源yaml)]，用于直接应用到集群而不用重新读资源文件
+        self.index = OutputIndex(self.output_dir) if write_output else None # 输出目录的资源索引
+        self.k8s_action = None # 渲染完后对集群执行的动作: apply/create/delete/diff，为空则只生成资源文件
+        self.prune = False # apply后是否删除过期资源
+        self.server_side = True # apply是否用服务端应用(server-side apply)，否则用create/patch
+        self.field_manager = self.managed_by # 服务端应用的字段管理者
+        self.force_conflicts = False # 服务端应用时，字段被其他管理者拥有是否强制接管
+        self.wait = False # 应用后是否等待资源就绪
+        self.wait_timeout = default_wait_timeout # 等待资源就绪的超时(秒)
+        self.generation = time.strftime('%Y%m%d-%H%M%S') # 本次执行的代次
+        self.metrics = RunMetrics() # 本次执行的指标
+
+        # 增量渲染的清单
+        self.manifest = None
+        if incremental:
+            self.manifest = Manifest(manifest_dir or self.output_dir)
+            track_input_funs()
 
         # app作用域的属性，跳出app时就清空
         self._app = '' # 应用名
@@ -91,6 +166,19 @@ class Boot(YamlBoot):
         self._service_type2ports = {} # 记录service类型对端口映射
         self._cname_ports = {} # 记录cname(externalName Service)的端口
         self._is_sts = False # 是否用 statefulset 来部署
+        self._vct_names = set() # 记录卷映射中引用的sts卷申请模板(volumeClaimTemplates)名
+        self._app_inputs = set() # 记录读取过的输入文件
+        self._app_files = set() # 记录生成的资源文件名
+        self._app_refs = set() # 记录引用过的其他app
+        self._app_deps = set() # 记录声明或引用配置的其他app
+
+        # k8s客户端: 延迟创建
+        self.k8s = None
+        self.k8s_options = {} # k8s客户端的选项: 连接池大小/限流/重试次数
+        self.context = None # kubeconfig中的上下文(集群)，默认为当前上下文
+        self.preloaded_yamls = None # 预先加载的资源，多集群执行时各集群共享
+        # 并发的资源应用器
+        self.applier = Applier(workers)
 
     # 清空app相关的属性
     def clear_app(self):
@@ -110,6 +198,11 @@ class Boot(YamlBoot):
         self._service_type2ports = {}  # 记service类型对端口映射
         self._cname_ports = {}  # 记录cname(externalName Service)的端口
         self._is_sts = False  # 是否用 statefulset 来部署
+        self._vct_names = set()  # 记录卷映射中引用的sts卷申请模板(volumeClaimTemplates)名
+        self._app_inputs = set()  # 记录读取过的输入文件
+        self._app_files = set()  # 记录生成的资源文件名
+        self._app_refs = set()  # 记录引用过的其他app
+        self._app_deps = set()  # 记录声明或引用配置的其他app
 
 
     # 自定义函数
@@ -128,6 +221,7 @@ class Boot(YamlBoot):
             app = self._app
         if not app:
             raise Exception('未指定app')
+        self.track_ref(app)
         if app not in self.app2ports:
             self.app2ports[app] = []
         return self.app2ports[app]
@@ -146,23 +240,69 @@ class Boot(YamlBoot):
             if self._app is None:
                 raise Exception(f"生成{res}资源文件失败: 没有指定应用")
             file = f"{self._app}-{res}.yml"
-        # 转yaml
-        if isinstance(data, list): # 多个资源
-            data = list(map(yaml.dump, data))
-            data = "\n---\n\n".join(data)
-        elif not isinstance(data, str):
-            data = yaml.dump(data)
+        # 打上管理者标签与内容hash
+        items = data if isinstance(data, list) else [data] # list表示多个资源
+        for item in items:
+            self.stamp_owner(item)
+            self.stamp_hash(item)
+        # 记录资源: 深拷贝，以免后续动作修改到共用的字典(如标签)
+        self._file2objects[file] = [(get_yaml_type(item), copy.deepcopy(item)) for item in items]
+        for item in items:
+            self.metrics.record_object(item.get('kind'))
+        if not self.write_output:
+            return
         # 创建目录
-        if not os.path.exists(self.output_dir):
-            os.makedirs(self.output_dir)
-        # 保存文件
-        file = os.path.join(self.output_dir, file)
-        write_file(file, data)
+        if not self._output_dir_created:
+            os.makedirs(self.output_dir, exist_ok=True)
+            self._output_dir_created = True
+        # 记录文件
+        self._written_files.add(file)
+        if self._app:
+            self._app_files.add(file)
+        # 保存文件: 流式写yaml，内容有变化才替换旧文件
+        spans = []
+        written = write_yaml_file(os.path.join(self.output_dir, file), data, spans)
+        if written:
+            self.file_stat['written'] += 1
+        else:
+            self.file_stat['unchanged'] += 1
+        self.metrics.record_file(spans[-1][0] + spans[-1][1] if spans else 0, written)
+        # 记录索引
+        self.index.record(file, items, spans)
+
+    def stamp_owner(self, yml):
+        '''
+        给资源打上管理者标签
+        :param yml 资源数据
+        '''
+        meta = yml['metadata']
+        # 拷贝，防止修改到共用的标签，如被用作selector的self._labels
+        meta['labels'] = dict(meta.get('labels') or {}, **{self.managed_by_label: self.managed_by})
+
+    def stamp_hash(self, yml):
+        '''
+        给资源打上内容hash的注解，apply时对比集群中资源的hash，相同则跳过
+        :param yml 资源数据
+        '''
+        meta = yml['metadata']
+        anns = dict(meta.get('annotations') or {}) # 拷贝，防止修改到调用方的注解，如ingress()的默认参数
+        anns.pop(self.hash_annotation, None)
+        if anns:
+            meta['annotations'] = anns
+        else:
+            meta.pop('annotations', None)
+        # 对不含hash注解的资源做hash，key排序保证稳定
+        txt = json.dumps(yml, sort_keys=True, ensure_ascii=False, default=str)
+        anns[self.hash_annotation] = hashlib.md5(txt.encode('utf-8')).hexdigest()
+        meta['annotations'] = anns
 
     def print_apply_cmd(self):
         '''
         打印 kubectl apply 命令
         '''
+        if self.k8s_action:
+            log.info(f'App[%s]的资源定义已生成完毕, 渲染完后将%s到集群', self._app, 'diff对比' if self.k8s_action == 'diff' else self.k8s_action)
+            return
         if self._is_name_gen:
             action = 'create'
         else:
@@ -171,39 +311,94 @@ class Boot(YamlBoot):
         log.info(cmd)
 
     # --------- 动作处理的函数 --------
-    # 修正节点标签
+    # 设置节点标签
+    @replace_var_on_params
     def node_labels(self, config):
-        old_node2labels = self.get_node2labels()
-        for node, new_labels in config.items():
-            if node in old_node2labels:
-                old_labels = old_node2labels[node]
-            else:
-                old_labels = {}
-            old_keys = old_labels.keys()
-            new_keys = new_labels.keys()
-            # 添加label
-            add_keys = new_keys - old_keys
-            # 删除label
-            del_keys = old_keys - new_keys
-            # 修改label
-            same_keys = old_keys & new_keys
-            for key in same_keys:
-                if old_labels[key] != new_labels[key]:
-                    pass
-
-    # 获得节点现有标签
-    def get_node2labels(self):
-        df = run_command_return_dataframe(f"kubectl get no  --show-labels")
-        node2labels = {}
-        for i, row in df.iterrows():
-            # 将 kubernetes.io/role=worker 变为 /role=worker
-            labels = re.sub(r'[^,]+\/', '', row['LABELS']).split(',')
-            labeldict = {}
-            for label in labels:
-                key, val = label.split('=')
-                labeldict[key] = val
-            node2labels[df['NAME']] = labeldict
-        return node2labels
+        '''
+        设置节点标签: 渲染完后应用到集群(--apply/--create)时修正节点标签，--diff时只输出要修正的标签
+        :param config 节点名(支持通配符，如 worker-*)对标签的映射，标签值为null表示删除该标签; 如
+                node1:
+                  disk: ssd
+                worker-*:
+                  role: worker
+                  gpu: ~
+        '''
+        if not isinstance(config, dict):
+            raise Exception('node_labels动作的参数必须是节点名对标签的字典')
+        for node, labels in config.items():
+            if not isinstance(labels, dict):
+                raise Exception(f'节点[{node}]的标签必须是字典')
+            self.node2labels.setdefault(str(node), {}).update({str(key): None if val is None else str(val) for key, val in labels.items()})
+        if not self.k8s_action:
+            log.info(f'节点标签已记录, 渲染完后用--apply/--create应用到集群, 或用--diff预览')
+
+    def plan_node_labels(self, nodes):
+        '''
+        对比节点的现有标签与配置的标签，计算最小的标签变更
+            新增/修改: 配置中有值的标签; 删除: 配置中值为null的标签
+            只处理本次渲染的配置所匹配的节点，以免删掉其他步骤文件设置的标签
+            --prune时才删除之前由K8sBoot设置、但配置中已去掉的标签(同资源的--prune，要渲染全部步骤文件)，此时检查所有节点
+        :param nodes 集群中的节点列表，元素是dict
+        :return [(节点名, 新增{标签: 值}, 修改{标签: (旧值, 新值)}, 删除{标签: 旧值}, 新的K8sBoot标签名集合)]，只含有变更的节点
+        '''
+        plans = []
+        matched = set()
+        for node in nodes:
+            meta = node['metadata']
+            name = meta['name']
+            olds = meta.get('labels') or {}
+            managed = set(filter(None, ((meta.get('annotations') or {}).get(self.node_labels_annotation) or '').split(',')))
+            # 按配置顺序合并匹配的标签，后面的优先
+            news = {}
+            for pattern, labels in self.node2labels.items():
+                if fnmatch.fnmatchcase(name, pattern):
+                    news.update(labels)
+                    matched.add(pattern)
+            if not news and not (self.prune and managed):
+                continue
+            adds = {key: val for key, val in news.items() if val is not None and key not in olds}
+            mods = {key: (olds[key], val) for key, val in news.items() if val is not None and key in olds and olds[key] != val}
+            dels = {key: olds[key] for key in olds if (news[key] is None if key in news else self.prune and key in managed)}
+            # 只记录K8sBoot设置过的标签，已有且值相同的标签(如kubelet设置的)不算，以免配置去掉后被误删
+            new_managed = {key for key, val in news.items() if val is not None and (key in managed or key in adds or key in mods)}
+            if not self.prune: # 配置中已去掉的标签没删，仍然记录，以便之后--prune时删除
+                new_managed |= {key for key in managed if key not in news and key in olds}
+            if adds or mods or dels or new_managed != managed:
+                plans.append((name, adds, mods, dels, new_managed))
+        for pattern in self.node2labels.keys() - matched:
+            log.warning(f"{self.cluster_label()}没有匹配[%s]的节点", pattern)
+        return plans
+
+    def reconcile_node_labels(self, dry_run = False):
+        '''
+        修正节点标签: 只调用一次list api获得所有节点，再并发地对有变更的节点调用patch api(只含变更的标签)
+        :param dry_run 是否只输出要修正的标签，而不调用patch api
+        :return 有变更的节点数
+        '''
+        if not self.node2labels and not self.prune: # --prune时要删除已从配置中去掉的标签
+            return 0
+        self.prepare_k8s_client()
+        plans = self.plan_node_labels(self.k8s.list('v1', 'Node'))
+        prefix = f"[{self.context}] " if self.context else '' # 指定集群时区分集群
+        patches = []
+        for name, adds, mods, dels, managed in plans:
+            if dry_run:
+                print(f"{prefix}~ v1 Node {name}")
+                for key, val in sorted(adds.items()):
+                    print(f"{prefix}    +{key}={val}")
+                for key, (old, val) in sorted(mods.items()):
+                    print(f"{prefix}    ~{key}: {old} -> {val}")
+                for key, old in sorted(dels.items()):
+                    print(f"{prefix}    -{key}={old}")
+            labels = {key: val for key, val in adds.items()}
+            labels.update((key, val) for key, (old, val) in mods.items())
+            labels.update((key, None) for key in dels) # 值为null表示删除
+            yml = {'apiVersion': 'v1', 'kind': 'Node', 'metadata': {'name': name, 'labels': labels, 'annotations': {self.node_labels_annotation: ','.join(sorted(managed)) or None}}}
+            patches.append(('node', yml))
+        log.info(f"{self.cluster_label()}node_labels汇总: 待修正节点%s个, 新增标签%s个, 修改%s个, 删除%s个", len(plans), sum(len(plan[1]) for plan in plans), sum(len(plan[2]) for plan in plans), sum(len(plan[3]) for plan in plans))
+        if patches and not dry_run:
+            self.applier.run(patches, lambda type, yml: self.k8s.patch(yml, None), 'node_labels')
+        return len(plans)
 
     # 设置与生成命名空间
     @replace_var_on_params
@@ -240,6 +435,14 @@ class Boot(YamlBoot):
             self._is_name_gen = True
         # app名可带参数
         name = replace_var(name)
+        start = time.perf_counter()
+        # 增量渲染: 输入未变更则跳过
+        fingerprint = None
+        if self.manifest is not None:
+            fingerprint = self.build_app_fingerprint(name, steps)
+            if self.manifest.is_fresh(name, fingerprint, self.build_ref_sign):
+                self.skip_app(name)
+                return
         self._app = name
         set_var('app', name)
         self._labels = {
@@ -255,9 +458,73 @@ class Boot(YamlBoot):
         self.service()
         # 打印 kubectl apply 命令
         self.print_apply_cmd()
+        self._rendered_apps.append(name)
+        # 依赖的app: 声明的+引用了端口的(如ingress的后端)+引用了配置的
+        self.app2deps[name] = sorted(self._app_deps | self._app_refs)
+        self.metrics.record_app(name, time.perf_counter() - start)
+        # 记录到增量渲染的清单
+        if self.manifest is not None:
+            state = {
+                'ports': self.app2ports.get(name, []),
+                'port2service': self.app2port2service.get(name, {}),
+                'deps': self.app2deps[name],
+            }
+            refs = {app: self.build_ref_sign(app) for app in self._app_refs}
+            self.manifest.record(name, fingerprint, self._app_inputs, self._app_files, state, refs)
         # 清空app相关的属性
         self.clear_app()
 
+    # 构建app的输入指纹: 步骤+变量+命名空间，输入文件与引用的其他app另外检查
+    def build_app_fingerprint(self, name, steps):
+        return build_fingerprint({
+            'name': name,
+            'steps': steps,
+            'vars': get_vars(),
+            'ns': self._ns,
+            'version': get_render_version(),
+        })
+
+    # 跳过未变更的app: 沿用上次生成的资源文件，并恢复跨app共享的端口状态
+    def skip_app(self, name):
+        log.debug(f"App[%s]的输入未变更, 跳过渲染", name)
+        rec = self.manifest.keep(name)
+        state = rec['state']
+        self.app2ports[name] = state['ports']
+        self.app2port2service[name] = {int(port): service for port, service in state['port2service'].items()} # json的key是str，要转回int
+        self.app2deps[name] = state['deps']
+        # 沿用上次引用的app
+        for app in rec['refs']:
+            self.track_ref(app)
+        # 沿用上次生成的资源文件，以便应用到集群
+        if self.k8s_action:
+            for file in rec['files']:
+                self._file2objects[file] = [(get_yaml_type(yml), yml) for yml in load_yaml_file(os.path.join(self.manifest.output_dir, file))]
+        self._rendered_apps.append(name)
+        self.metrics.record_skipped_app(name)
+        self.clear_app()
+
+    # 记录当前app读取过的输入文件，用于增量渲染
+    def track_input(self, path):
+        if self.manifest is not None and self._app:
+            self._app_inputs.add(os.path.abspath(path))
+
+    # 读步骤文件，主要是记录app中include的文件
+    def read_cached_step_file(self, step_file):
+        self.track_input(step_file)
+        return super().read_cached_step_file(step_file)
+
+    # 执行完的后置处理: 保存增量渲染的清单
+    def on_end(self):
+        if self.write_output:
+            log.info(f"资源文件已生成到目录%s: 写入%s个, 未变更%s个", self.output_dir, self.file_stat['written'], self.file_stat['unchanged'])
+        # 并行渲染的子进程中，清单由主进程合并后保存
+        if self.manifest is not None and self.manifest.output_dir == self.output_dir:
+            self.manifest.clean_stale_files(self._written_files)
+            self.manifest.save()
+        # 保存资源索引
+        if self.index is not None:
+            self.index.save()
+
     @replace_var_on_params
     def labels(self, lbs):
         '''
@@ -267,6 +534,25 @@ class Boot(YamlBoot):
         '''
         self._labels.update(lbs)
 
+    @replace_var_on_params
+    def depends_on(self, apps):
+        '''
+        声明当前app依赖的其他app: 应用到集群时，先应用被依赖的app并等待其就绪，再应用当前app
+            引用了其他app的端口(如ingress的后端)或配置(如ref_config(mysql.host))，也会自动视为依赖
+        :param apps 依赖的app名，list类型或逗号分隔的字符串
+        '''
+        if not self._app:
+            raise Exception('depends_on动作只能在app动作内使用')
+        if isinstance(apps, str):
+            apps = apps.split(',')
+        for app in apps:
+            self.track_dep(app.strip())
+
+    # 记录当前app依赖的其他app
+    def track_dep(self, app):
+        if self._app and app != self._app:
+            self._app_deps.add(app)
+
     @replace_var_on_params
     def config(self, data):
         '''
@@ -304,6 +590,7 @@ class Boot(YamlBoot):
         # 1 dict
         if isinstance(files, dict):
             for key, file in files.items():
+                self.track_input(file)
                 files[key] = read_file(file)
             return files
 
@@ -322,6 +609,7 @@ class Boot(YamlBoot):
             ret = {}
             for file in files:
                 key = os.path.basename(file) # 文件名作为key
+                self.track_input(file)
                 ret[key] = read_file(file)
             return ret
 
@@ -410,8 +698,9 @@ class Boot(YamlBoot):
     def rc(self, option):
         '''
         生成rc
-        :param option 部署选项 {replicas}
+        :param option 部署选项 {replicas, pdb}
                         replicas 副本数
+                        pdb 中断预算，参考 build_pdb()
         '''
         option = self.fix_replicas_option(option, 'rc')
         yaml = {
@@ -427,13 +716,15 @@ class Boot(YamlBoot):
         }
 
         self.save_yaml(yaml, 'rc')
+        self.build_pdb(option)
 
     @replace_var_on_params
     def rs(self, option):
         '''
         生成rs
-        :param option 部署选项 {replicas}
+        :param option 部署选项 {replicas, pdb}
                         replicas 副本数
+                        pdb 中断预算，参考 build_pdb()
         '''
         option = self.fix_replicas_option(option, 'rs')
         yaml = {
@@ -448,6 +739,7 @@ class Boot(YamlBoot):
         }
 
         self.save_yaml(yaml, 'rs')
+        self.build_pdb(option)
 
     @replace_var_on_params
     def ds(self, option):
@@ -473,11 +765,30 @@ class Boot(YamlBoot):
     def sts(self, option):
         '''
         生成 StatefulSet
-        :params option 部署选项 {replicas, nodeSelector}
+        :params option 部署选项 {replicas, nodeSelector, volumeClaimTemplates, podManagementPolicy, partition}
                         replicas 副本数
                         nodeSelector 节点选择，如 "kubernetes.io/os": "linux" 或 "disk": "ssd"
+                        volumeClaimTemplates 每个副本专有的卷申请模板，卷名对大小或pvc选项(同pvc动作)，如 data: 10Gi 或 data: {size: 10Gi, storageClassName: local}
+                                             在容器的卷映射中用 vct://卷名:容器路径 来挂载
+                        podManagementPolicy pod管理策略: OrderedReady(默认，逐个按序启停) 或 Parallel(并行启停)
+                        parallel podManagementPolicy: Parallel 的简写
+                        partition 分区更新: 只更新序号>=partition的pod，用于金丝雀发布
+                        updateStrategy 更新策略，指定partition时可省
+                        pdb 中断预算，参考 build_pdb()
         '''
         option = self.fix_replicas_option(option, 'sts')
+        vcts = self.build_volume_claim_templates(option.get("volumeClaimTemplates"))
+        undeclared = self._vct_names - {vct["metadata"]["name"] for vct in vcts or []}
+        if undeclared:
+            raise Exception(f"卷映射中引用了未声明的卷申请模板: {', '.join(sorted(undeclared))}, 请在sts动作的volumeClaimTemplates中声明")
+        update_strategy = option.get("updateStrategy")
+        if option.get("partition") is not None:
+            update_strategy = {
+                "type": "RollingUpdate",
+                "rollingUpdate": {
+                    "partition": int(option["partition"])
+                }
+            }
         yaml = {
             "apiVersion": "apps/v1",
             "kind": "StatefulSet",
@@ -485,22 +796,86 @@ class Boot(YamlBoot):
             "spec": {
                 "replicas": option.get("replicas", 1),
                 "serviceName": self._app,
+                "podManagementPolicy": 'Parallel' if option.get("parallel") else option.get("podManagementPolicy"),
+                "updateStrategy": update_strategy,
                 "selector": self.build_selector(option.get("selector")),
-                "template": self.build_pod_template(option)
+                "template": self.build_pod_template(option, for_sts=True),
+                "volumeClaimTemplates": vcts,
             }
         }
+        del_dict_none_item(yaml["spec"])
 
         self.save_yaml(yaml, 'sts')
+        self.build_pdb(option)
 
         self._is_sts = True
 
+    def build_pdb(self, option):
+        '''
+        生成工作负载的中断预算(PodDisruptionBudget): 限制节点排空(drain)等自愿中断时同时被驱逐的pod数，选择器同工作负载
+        :param option 工作负载的选项，其中pdb为
+                        int或百分比: 最少可用的pod数，即minAvailable，如 2 或 50%
+                        dict: {minAvailable} 或 {maxUnavailable}，二选一，其他键原样输出，如 unhealthyPodEvictionPolicy
+        '''
+        pdb = option.get("pdb")
+        if pdb is None:
+            return
+        if not isinstance(pdb, dict):
+            pdb = {"minAvailable": pdb}
+        pdb = {key: (int(val) if isinstance(val, str) and val.isdigit() else val) for key, val in pdb.items()} # 数字字符串(如变量替换后)转int，百分比不变
+        if ("minAvailable" in pdb) == ("maxUnavailable" in pdb):
+            raise Exception(f"应用[{self._app}]的pdb选项必须指定minAvailable或maxUnavailable之一: {pdb}")
+        # 最少可用数不小于副本数，则任何pod都不能被驱逐，节点排空会卡住
+        min_available = pdb.get("minAvailable")
+        if isinstance(min_available, int) and min_available >= int(option.get("replicas", 1)):
+            log.warning(f"应用[%s]的pdb minAvailable(%s)不小于副本数(%s), 节点排空时其pod将无法被驱逐", self._app, min_available, option.get("replicas", 1))
+        yaml = {
+            "apiVersion": "policy/v1",
+            "kind": "PodDisruptionBudget",
+            "metadata": self.build_metadata(),
+            "spec": {
+                **pdb,
+                "selector": self.build_selector(option.get("selector")),
+            }
+        }
+        self.save_yaml(yaml, 'pdb')
+
+    def build_volume_claim_templates(self, option):
+        '''
+        构建sts的卷申请模板(volumeClaimTemplates): 每个副本一个pvc，名为 卷名-sts名-序号
+        :param option 卷名对大小或pvc选项，如 data: 10Gi 或 data: {size: 10Gi, storageClassName: local, accessModes: [ReadWriteOnce]}
+        '''
+        if not option:
+            return None
+        ret = []
+        for name, item in option.items():
+            if not isinstance(item, dict):
+                item = {"size": item}
+            item = dict(item)
+            ret.append({
+                "metadata": {
+                    "name": name
+                },
+                "spec": {
+                    "accessModes": get_and_del_dict_item(item, "accessModes", ["ReadWriteOnce"]),
+                    "resources": {
+                        "requests": {
+                            "storage": str(get_and_del_dict_item(item, "size"))
+                        }
+                    },
+                    **item
+                }
+            })
+        return ret
+
     @replace_var_on_params
     def deploy(self, option):
         '''
         生成部署
-        :params option 部署选项 {replicas, nodeSelector}
+        :params option 部署选项 {replicas, nodeSelector, pdb}
                         replicas 副本数
                         nodeSelector 节点选择，如 "kubernetes.io/os": "linux" 或 "disk": "ssd"
+                        pdb 中断预算，参考 build_pdb()
         '''
         option = self.fix_replicas_option(option, 'deploy')
         yaml = {
@@ -514,6 +889,7 @@ class Boot(YamlBoot):
             }
         }
         self.save_yaml(yaml, 'deploy')
+        self.build_pdb(option)
 
     @replace_var_on_params
     def job(self, option):
@@ -522,8 +898,12 @@ class Boot(YamlBoot):
         :params option 部署选项 {completions, parallelism, activeDeadlineSeconds, backoffLimit, ttlSecondsAfterFinished, nodeSelector}
                         completions 标志Job结束需要成功运行的Pod个数，默认为1
                         parallelism 标志并行运行的Pod的个数，默认为1
+                        shards 分片数，即Indexed模式的completions简写: 每个分片(序号0~N-1)一个pod，容器中有环境变量SHARD_INDEX(分片序号)与SHARD_COUNT(分片数)，parallelism默认为分片数
+                        completionMode 完成模式，NonIndexed(默认)或Indexed，指定shards则为Indexed
                         activeDeadlineSeconds 表示 Pod 可以运行的最长时间，达到设置的该值后，Pod 会自动停止，优先于 backoffLimit
-                        backoffLimit 最大允许失败的次数，默认6
+                        backoffLimit 最大允许失败的次数，默认6(指定了backoffLimitPerIndex则默认不限)
+                        backoffLimitPerIndex 每个分片最大允许失败的次数，仅用于Indexed模式，一个分片失败不影响其他分片
+                        maxFailedIndexes 最大允许失败的分片数，超过则job失败，仅用于backoffLimitPerIndex
                         ttlSecondsAfterFinished 任务完成后的n秒后自动删除pod
                         nodeSelector 节点选择，如 "kubernetes.io/os": "linux" 或 "disk": "ssd"
                         command 任务命令，仅当没有调用containers动作时才有效，它会构建一个busybox的container
@@ -539,15 +919,31 @@ class Boot(YamlBoot):
     def build_job(self, option, by_cronjob = False):
         # 当有command时，尝试构建一个busybox的container来运行命令
         self.build_busybox_container_for_command(option.get('command'))
+        # 分片: Indexed模式
+        shards = option.get("shards")
+        if shards is not None:
+            shards = int(shards)
+            if shards < 1:
+                raise Exception(f'job的分片数必须大于0: {shards}')
+        indexed = shards is not None or option.get("completionMode") == 'Indexed'
+        completions = shards if shards is not None else option.get("completions", 1)
+        backoff_per_index = option.get("backoffLimitPerIndex")
+        if backoff_per_index is not None and not indexed:
+            raise Exception('backoffLimitPerIndex只能用于分片(Indexed模式)的job')
         # 构建job
         job = {
-            "completions": option.get("completions", 1),
-            "parallelism": option.get("parallelism", 1),
+            "completionMode": 'Indexed' if indexed else None,
+            "completions": completions,
+            "parallelism": option.get("parallelism", completions if shards is not None else 1),
             "activeDeadlineSeconds": option.get("activeDeadlineSeconds"),
-            "backoffLimit": option.get("backoffLimit", 6),
+            "backoffLimit": option.get("backoffLimit", 6 if backoff_per_index is None else None),
+            "backoffLimitPerIndex": backoff_per_index,
+            "maxFailedIndexes": option.get("maxFailedIndexes"),
             "ttlSecondsAfterFinished": option.get("ttlSecondsAfterFinished"),
             "template": self.build_pod_template(option, restartPolicy="Never") # pod启动失败时不会重启，而是通过job-controller重新创建pod供节点调度。
         }
+        if indexed:
+            self.add_shard_env(job["template"], completions)
         # cronjob.jobTemplate 不用指定 selector
         if not by_cronjob:
             job["manualSelector"] = True  # 是否可以使用 selector 选择器选择 pod，默认是 false
@@ -555,6 +951,25 @@ class Boot(YamlBoot):
         del_dict_none_item(job)
         return job
 
+    def add_shard_env(self, template, count):
+        '''
+        给Indexed模式的job的容器加上分片的环境变量: SHARD_INDEX 分片序号(来自job-controller打上的注解), SHARD_COUNT 分片数
+            容器中已有的同名环境变量优先；拷贝容器，不影响app的其他资源
+        :param template pod模板
+        :param count 分片数
+        '''
+        shard_env = [
+            {"name": "SHARD_INDEX", "valueFrom": self.ref_pod_field("metadata.annotations['batch.kubernetes.io/job-completion-index']")},
+            {"name": "SHARD_COUNT", "value": str(count)},
+        ]
+        containers = []
+        for container in template["spec"]["containers"]:
+            env = list(container.get("env") or [])
+            names = {item["name"] for item in env}
+            env.extend(item for item in shard_env if item["name"] not in names)
+            containers.append(dict(container, env=env))
+        template["spec"]["containers"] = containers
+
     # 当没有调用containers动作时，构建一个busybox的container来运行命令
     def build_busybox_container_for_command(self, cmd):
         if cmd is not None and not self._containers:
@@ -704,7 +1119,7 @@ class Boot(YamlBoot):
                 item['effect'] = effect
             if toleration:
                 if '=' in toleration:
-                    item['key'], item['vale'] = toleration.split('=')
+                    item['key'], item['value'] = toleration.split('=')
                     item['operator'] = 'Equal'
                 else:
                     item['key'] = toleration
@@ -713,7 +1128,46 @@ class Boot(YamlBoot):
             ret.append(item)
         return ret
 
-    def build_pod_template(self, option, restartPolicy = "Always"):
+    # 拓扑域的简称对应的节点标签
+    topology_keys = {
+        'host': 'kubernetes.io/hostname',
+        'zone': 'topology.kubernetes.io/zone',
+        'region': 'topology.kubernetes.io/region',
+    }
+
+    def build_spread(self, spread, selector = None):
+        '''
+        构建拓扑分布约束(topologySpreadConstraints)，pod选择器同 build_selector()
+        :params spread 单个或多个约束，每个约束的格式为
+                    字符串: 拓扑域[:maxSkew]，拓扑域可为简称 host/zone/region 或节点标签名，maxSkew默认为1，如 zone 或 host:2
+                    dict: {key, maxSkew, whenUnsatisfiable, ...}，key同上，whenUnsatisfiable默认为DoNotSchedule(硬约束)，ScheduleAnyway则为软约束，其他键原样输出，如 minDomains
+        :params selector 工作负载的选择器
+        '''
+        if not spread:
+            return None
+        if not isinstance(spread, list):
+            spread = [spread]
+
+        ret = []
+        for item in spread:
+            if isinstance(item, str):
+                key, _, skew = item.partition(':')
+                item = {'key': key, 'maxSkew': skew or 1}
+            else:
+                item = dict(item)
+            key = get_and_del_dict_item(item, 'key')
+            if not key:
+                raise Exception(f"拓扑分布约束缺少拓扑域: {item}")
+            ret.append({
+                'maxSkew': int(get_and_del_dict_item(item, 'maxSkew', 1)),
+                'topologyKey': self.topology_keys.get(key, key),
+                'whenUnsatisfiable': get_and_del_dict_item(item, 'whenUnsatisfiable', 'DoNotSchedule'),
+                'labelSelector': self.build_selector(selector),
+                **item
+            })
+        return ret
+
+    def build_pod_template(self, option, restartPolicy = "Always", for_sts = False):
         '''
         构建pod模板
         :param option {nodeSelector, tolerations}
@@ -721,12 +1175,16 @@ class Boot(YamlBoot):
                       nodeAffinity 节点亲和性，如 "kubernetes.io/os": "linux" 或 "disk": "ssd"
                       podAffinity pod亲和性，如 "kubernetes.io/os": "linux" 或 "disk": "ssd"
                       tolerations 容忍
+                      spread 拓扑分布约束，让副本均匀分布到各可用区/节点，如 zone 或 host:2，参考 build_spread()
                       activeDeadlineSeconds 表示 Pod 可以运行的最长时间，达到设置的该值后，Pod 会自动停止。
                       hostname pod的主机名, 如果设置的值为空, 则取app名
                       hostAliases或hosts ip对域名的映射，如 192.168.62.209: kafka-broker
         :param restartPolicy 重启策略，默认为Always，对job为Never
+        :param for_sts 是否用于sts，只有sts才能用 vct:// 卷映射
         :return
         '''
+        if self._vct_names and not for_sts:
+            raise Exception(f"卷映射 vct:// 只能用于sts动作")
         spec = {
             "activeDeadlineSeconds": option.get('activeDeadlineSeconds'),
             "hostAliases": self.build_hosts(option.get('hostAliases') or option.get('hosts')),
@@ -737,6 +1195,7 @@ class Boot(YamlBoot):
             "nodeSelector": option.get('nodeSelector'),
             "affinity": self.build_affinities(option.get('nodeAffinity'), option.get('podAffinity'), option.get('podAntiAffinity')),
             "tolerations": self.build_tolerations(option.get('tolerations')),
+            "topologySpreadConstraints": self.build_spread(option.get('spread'), option.get('selector')),
         }
         del_dict_none_item(spec)
         # 处理hostNetwork，要加上dnsPolicy
@@ -1084,8 +1543,40 @@ class Boot(YamlBoot):
 
     # 通过服务端口来获得服务名: ingress用到
     def get_service_name_by_port(self, service_port, app):
+        self.track_ref(app)
         return self.app2port2service[app][service_port]
 
+    # 记录引用过的其他app，其端口变化会影响当前app的渲染结果
+    def track_ref(self, app):
+        if app == self._app:
+            return
+        self._app_refs.add(app)
+        if app not in self._rendered_apps:
+            self._foreign_refs.add(app)
+
+    # 获得app端口状态的签名，用于增量渲染时检查引用的app是否有变化
+    def build_ref_sign(self, app):
+        return build_fingerprint([self.app2ports.get(app), self.app2port2service.get(app)])
+
+    # 导出本次渲染对跨步骤文件共享状态的贡献: 设置的命名空间+渲染的app的端口，用于并行渲染
+    def export_state(self):
+        return {
+            'ns': '' if self._ns_imported else self._ns,
+            'app2ports': {app: self.app2ports[app] for app in self._rendered_apps if app in self.app2ports},
+            'app2port2service': {app: self.app2port2service[app] for app in self._rendered_apps if app in self.app2port2service},
+            'app2deps': {app: self.app2deps[app] for app in self._rendered_apps if app in self.app2deps},
+            'node2labels': self.node2labels,
+        }
+
+    # 导入其他步骤文件渲染出的共享状态，用于并行渲染
+    def import_state(self, state):
+        if state['ns']:
+            self._ns = state['ns']
+            self._ns_imported = True
+            set_var('ns', state['ns'])
+        self.app2ports.update(state['app2ports'])
+        self.app2port2service.update(state['app2port2service'])
+
     def build_service_type2ports(self):
         '''
         构建service需要的端口
@@ -1585,6 +2076,8 @@ class Boot(YamlBoot):
                     pvc://pvc1:/usr/share/nginx/html -- 将pvc1挂载为目录
                     pvc://pvc1/subpath:/usr/share/nginx/html -- 将pvc1的子目录subpath挂载为目录
                     pvc:///subpath:/usr/share/nginx/html -- 将当前应用的pvc的子目录subpath挂载为目录
+                    vct://data:/var/lib/kafka -- 将sts的卷申请模板data(每个副本专有的pvc)挂载为目录，模板在sts动作的volumeClaimTemplates中声明
+                    vct://data/subpath:/var/lib/kafka -- 将sts的卷申请模板data的子目录subpath挂载为目录
                     其中生成的卷名为 vol-md5(最后一个:之前的部分)
         '''
         if mounts is None or len(mounts) == 0:
@@ -1619,7 +2112,7 @@ class Boot(YamlBoot):
                 else:
                     host = ''
                     host_path = host_and_path
-                vol = self.build_volume(protocol, host, host_path)
+                vol = self.build_volume(protocol, host, host_path) if protocol != 'vct' else None # sts的卷申请模板不用声明卷
             elif ':' in mount: # 无协议+有本地卷映射，如 /lnmp/www/:/www
                 host_path, mount_path = mount.split(':', 1)
                 vol = {
@@ -1636,6 +2129,12 @@ class Boot(YamlBoot):
             # name = 'vol-' + md5(mount_path)
             name = mount.rsplit(':', 1)[0]
             name = 'vol-' + md5(name)
+            # sts的卷申请模板: 卷名即模板名，有host则host_path为子路径
+            if protocol == 'vct':
+                name = host or host_path.strip('/') or 'data'
+                if host:
+                    host_path = host_path[1:] # 干掉开头的/
+                self._vct_names.add(name)
             yaml = {
                 "name": name,
                 "mountPath": mount_path
@@ -1647,14 +2146,17 @@ class Boot(YamlBoot):
             # pvc有host=pvc名, 而host_path=子路径, 两者用/分割
             if protocol == 'pvc' and host:
                 yaml['subPath'] = host_path[1:] #干掉开头的/
+            if protocol == 'vct' and host and host_path:
+                yaml['subPath'] = host_path
             # 只读
             if ro:
                 yaml['readOnly'] = True
             ret.append(yaml)
 
             # 4 记录卷
-            vol["name"] = name
-            self._volumes[name] = vol # 用name来去重
+            if vol is not None:
+                vol["name"] = name
+                self._volumes[name] = vol # 用name来去重
         return ret
 
     def build_probe(self, option):
@@ -1807,6 +2309,7 @@ class Boot(YamlBoot):
         '''
         if '.' in key:
             name, key = key.split('.')
+            self.track_dep(name) # 引用其他app的配置
         else:
             name = self._app
         return {
@@ -1823,6 +2326,7 @@ class Boot(YamlBoot):
         '''
         if '.' in key:
             name, key = key.split('.')
+            self.track_dep(name) # 引用其他app的密文
         else:
             name = self._app
         return {
@@ -1857,8 +2361,10 @@ class Boot(YamlBoot):
             raise Exception(f"env_file参数[{path}]非list类型")
 
         # 收集.env文件中的变量
+        from dotenv import dotenv_values # 延迟导入，只有用到env_file才需要
         env = {}
         for file in files:
+            self.track_input(file)
             vars = dotenv_values(file) # 读.env文件中的变量
             env.update(vars)
         return self.build_env(env)
@@ -1918,165 +2424,582 @@ class Boot(YamlBoot):
     # --------- 应用k8s资源文件 --------
     # 创建k8s资源文件: 使用create api
     def create(self):
-        self.prepare_k8s_apis()
-        for type, yml in self.yield_output_yamls():
-            func = self.create_apis[type] # 获得创建方法
-            if type == 'ns' or type == 'pv':
-                func(body=yml)
-            else:
-                func(namespace=self._ns, body=yml)
+        start = time.time()
+        ymls = self.prepare_yamls()
+        self.reconcile_node_labels() # 先修正节点标签，以便工作负载按标签调度
+        self.run_app_levels(ymls, ymls, self.create_yaml, 'create', start)
 
-    # 应用k8s资源文件: 使用 patch api
+    # 应用k8s资源文件: hash有变化或集群中不存在则用服务端应用(或create/patch api), 否则跳过
     def apply(self):
-        self.prepare_k8s_apis()
-        for type, yml in self.yield_output_yamls():
-            func = self.patch_apis[type] # 获得创建方法
-            if type == 'ns' or type == 'pv':
-                func(body=yml)
+        start = time.time()
+        ymls = self.prepare_yamls()
+        self.reconcile_node_labels() # 先修正节点标签，以便工作负载按标签调度
+        # 批量获得集群中资源的hash
+        live_hashes = self.fetch_live_hashes(ymls)
+        # 对比hash，分为新增/变更/跳过
+        news = []
+        changes = []
+        skips = []
+        for type, yml in ymls:
+            key = self.get_yaml_key(yml)
+            if key is None or key not in live_hashes: # 自动生成资源名 或 集群中不存在
+                news.append((type, yml))
+            elif live_hashes[key] != yml['metadata'].get('annotations', {}).get(self.hash_annotation):
+                changes.append((type, yml))
+            else:
+                skips.append((type, yml))
+        log.info(f"{self.cluster_label()}apply汇总: 新增%s个, 变更%s个, 跳过%s个(未变更)", len(news), len(changes), len(skips))
+
+        change_ids = {id(yml) for type, yml in changes}
+        hpa_targets = self.get_hpa_targets(ymls)
+        def apply1(type, yml):
+            if self.server_side and yml['metadata'].get('name'): # 服务端应用要有资源名，自动生成资源名的只能create
+                if (yml['kind'], self.get_yaml_namespace(yml), yml['metadata']['name']) in hpa_targets:
+                    yml = self.drop_replicas(yml)
+                self.apply_yaml(type, yml)
+            elif id(yml) in change_ids:
+                self.patch_yaml(type, yml)
+            else:
+                self.create_yaml(type, yml)
+        self.run_app_levels(ymls, news + changes, apply1, 'apply', start)
+        if self.prune:
+            self.prune_yamls(ymls)
+
+    def run_app_levels(self, ymls, todo, func, action, start):
+        '''
+        按app之间的依赖分层执行: 层之间串行，前一层的app就绪后才执行下一层；同层的app互不依赖，其资源按类型分批次并发执行
+        :param ymls 全部资源，用于等待就绪，元素是(资源类型, 资源yaml)
+        :param todo 要调用api的资源
+        :param func 处理单个资源的函数
+        :param action 动作名
+        :param start 开始应用的时间，用于计算就绪耗时
+        '''
+        levels = self.build_app_levels(ymls)
+        deadline = time.time() + self.wait_timeout # 所有层共用一个超时
+        done = set() # 已执行的app
+        waited = set() # 已等待就绪的app
+        for i, apps in enumerate(levels):
+            # 只等待本层app所依赖的app就绪，没被依赖的app(如批处理Job)不阻塞后面的层
+            deps = {dep for app in apps if app for dep in self.app2deps.get(app) or []} & done - waited
+            if deps:
+                self.wait_ready([(type, yml) for type, yml in ymls if self.get_yaml_app(yml) in deps], start, deadline)
+                waited |= deps
+            if len(levels) > 1:
+                log.info(f"{self.cluster_label()}{action}第%s/%s层: %s", i + 1, len(levels), ', '.join(sorted(app for app in apps if app)))
+            self.applier.run([(type, yml) for type, yml in todo if self.get_yaml_app(yml) in apps], func, action)
+            done |= apps
+        # 指定了--wait才等待其余的app
+        if self.wait:
+            self.wait_ready([(type, yml) for type, yml in ymls if self.get_yaml_app(yml) not in waited], start, deadline)
+
+    def build_app_levels(self, ymls):
+        '''
+        按app之间的依赖分层: 被依赖的app在前面的层，只考虑本次渲染的app之间的依赖
+        :param ymls 资源列表，元素是(资源类型, 资源yaml)
+        :return 层列表，元素是app集合；不属于app的资源(如命名空间)对应None，放在第一层
+        '''
+        apps = {self.get_yaml_app(yml) for type, yml in ymls}
+        todo = apps - {None}
+        deps = {app: set(self.app2deps.get(app) or []) & todo for app in todo}
+        levels = []
+        done = set()
+        while todo:
+            level = {app for app in todo if deps[app] <= done}
+            if not level:
+                raise Exception(f"app之间有循环依赖: {', '.join(sorted(todo))}")
+            levels.append(level)
+            done |= level
+            todo -= level
+        if None in apps:
+            if levels:
+                levels[0].add(None)
             else:
-                func(namespace=self._ns, body=yml)
+                levels.append({None})
+        return levels
+
+    # 获得资源所属的app
+    def get_yaml_app(self, yml):
+        return (yml['metadata'].get('labels') or {}).get('app')
+
+    def wait_ready(self, ymls, start, deadline = None):
+        '''
+        等待应用的工作负载(Deployment/StatefulSet/DaemonSet)滚动更新完成、Job完成、PVC绑定
+            每个资源类型+命名空间只开一个watch流，并输出每个app的就绪耗时
+        :param ymls 应用的资源列表，元素是(资源类型, 资源yaml)
+        :param start 开始应用的时间，用于计算就绪耗时
+        :param deadline 超时的时间点，默认为当前时间+超时
+        '''
+        from K8sBoot.waiter import Waiter, wait_kinds
+        targets = []
+        for type, yml in ymls:
+            key = self.get_yaml_key(yml)
+            if key is not None and yml['kind'] in wait_kinds:
+                targets.append((key, self.get_yaml_app(yml)))
+        if not targets:
+            return
+        timeout = self.wait_timeout if deadline is None else max(0, deadline - time.time())
+        waiter = Waiter(self.k8s, timeout, start)
+        waiter.wait(targets)
+        waiter.report()
+        for app, seconds in waiter.app_ready_seconds().items():
+            self.metrics.record_app_ready(app, seconds)
+        if waiter.failures or waiter.pendings:
+            raise Exception(f"等待资源就绪失败: 失败{len(waiter.failures)}个, 超时{len(waiter.pendings)}个")
+
+    def prune_yamls(self, ymls):
+        '''
+        删除过期资源: 集群中有管理者标签、但本次没有渲染的资源，如已从步骤文件中移除的app的资源
+            每个资源类型+命名空间只调用一次按管理者标签过滤的list api
+            只检查本次渲染涉及的命名空间，因此要渲染全部步骤文件
+        :param ymls 本次渲染的资源列表，元素是(资源类型, 资源yaml)
+        '''
+        rendered = set()
+        kinds = set(self.prune_kinds)
+        for type, yml in ymls:
+            key = self.get_yaml_key(yml)
+            if key is not None and key[2] is not None: # 集群级资源(如命名空间)不删除
+                rendered.add(key)
+                kinds.add(key[:2])
+        namespaces = {key[2] for key in rendered} or {self._ns or 'default'}
+        selector = f"{self.managed_by_label}={self.managed_by}"
+        stales = []
+        for api_version, kind in sorted(kinds):
+            if not self.k8s.has_resource(api_version, kind): # 集群版本不支持，如旧集群没有autoscaling/v2
+                continue
+            for ns in sorted(namespaces):
+                for item in self.k8s.list(api_version, kind, ns, selector):
+                    meta = item['metadata']
+                    if (api_version, kind, ns, meta['name']) in rendered:
+                        continue
+                    log.info(f"prune: 过期资源%s %s/%s, 代次%s", kind, ns, meta['name'], (meta.get('labels') or {}).get(self.generation_label))
+                    yml = {'apiVersion': api_version, 'kind': kind, 'metadata': {'name': meta['name'], 'namespace': ns}}
+                    stales.append((get_yaml_type(yml), yml))
+        log.info(f"{self.cluster_label()}prune汇总: 过期%s个", len(stales))
+        if stales:
+            self.applier.run(stales, self.delete_yaml, 'prune', True)
+
+    # 用create api创建单个资源
+    def create_yaml(self, type, yml):
+        self.k8s.create(self.stamp_generation(yml), self.get_yaml_namespace(yml))
+
+    # 用服务端应用创建或更新单个资源
+    def apply_yaml(self, type, yml):
+        self.k8s.apply(self.stamp_generation(yml), self.get_yaml_namespace(yml), self.field_manager, self.force_conflicts)
+
+    # 用patch api更新单个资源
+    def patch_yaml(self, type, yml):
+        self.k8s.patch(self.stamp_generation(yml), self.get_yaml_namespace(yml))
+
+    def get_hpa_targets(self, ymls):
+        '''
+        获得被hpa扩缩容的工作负载
+        :param ymls 资源列表，元素是(资源类型, 资源yaml)
+        :return {(kind, 命名空间, 资源名)}
+        '''
+        ret = set()
+        for type, yml in ymls:
+            if yml['kind'] == 'HorizontalPodAutoscaler':
+                ref = yml['spec']['scaleTargetRef']
+                ret.add((ref['kind'], self.get_yaml_namespace(yml), ref['name']))
+        return ret
+
+    def drop_replicas(self, yml):
+        '''
+        去掉工作负载的副本数: 副本数由hpa通过scale子资源管理(字段归属于hpa)，服务端应用时带上会报字段冲突，或跟hpa争抢副本数
+        :param yml 资源yaml
+        :return 去掉副本数后的拷贝
+        '''
+        yml = dict(yml)
+        yml['spec'] = {k: v for k, v in yml['spec'].items() if k != 'replicas'}
+        return yml
+
+    def stamp_generation(self, yml):
+        '''
+        打上本次执行的代次标签: 不计入内容hash，因此未变更而跳过的资源保留原代次，以免每次都要更新全部资源
+        :param yml 资源yaml
+        :return 打上标签后的拷贝
+        '''
+        yml = dict(yml)
+        meta = yml['metadata'] = dict(yml['metadata'])
+        meta['labels'] = dict(meta.get('labels') or {}, **{self.generation_label: self.generation})
+        return yml
+
+    # 用delete api删除单个资源
+    def delete_yaml(self, type, yml):
+        self.k8s.delete(yml, self.get_yaml_namespace(yml))
+
+    def fetch_live_hashes(self, ymls):
+        '''
+        批量获得集群中资源的内容hash: 每个资源类型+命名空间只调用一次list api
+        :param ymls 资源列表，元素是(资源类型, 资源yaml)
+        :return {(apiVersion, kind, 命名空间, 资源名): hash}
+        '''
+        ret = {}
+        for key, item in self.fetch_live_objects(ymls).items():
+            anns = item['metadata'].get('annotations') or {}
+            ret[key] = anns.get(self.hash_annotation)
+        return ret
+
+    def fetch_live_objects(self, ymls, by_app = False, filtered = None):
+        '''
+        批量获得集群中的资源: 每个资源类型+命名空间只调用一次list api
+        :param ymls 资源列表，元素是(资源类型, 资源yaml)
+        :param by_app 是否按app标签过滤，只有该资源类型+命名空间下的资源都有app标签才过滤
+        :param filtered 用于收集按app标签过滤了的(apiVersion, kind, 命名空间)
+        :return {(apiVersion, kind, 命名空间, 资源名): 资源dict}
+        '''
+        # 收集资源类型+命名空间，及其下的app
+        key2apps = {}
+        for type, yml in ymls:
+            key = self.get_yaml_key(yml)
+            if key is None:
+                continue
+            apps = key2apps.setdefault(key[:3], set())
+            if apps is not None:
+                app = (yml['metadata'].get('labels') or {}).get('app')
+                if app:
+                    apps.add(app)
+                else: # 有资源没有app标签，不能过滤
+                    key2apps[key[:3]] = None
+        # 逐个调用list api
+        ret = {}
+        for (api_version, kind, ns), apps in key2apps.items():
+            selector = f"app in ({','.join(sorted(apps))})" if by_app and apps else None
+            if selector and filtered is not None:
+                filtered.add((api_version, kind, ns))
+            for item in self.k8s.list(api_version, kind, ns, selector):
+                ret[(api_version, kind, ns, item['metadata']['name'])] = item
+        return ret
+
+    # 获得资源的唯一标识: (apiVersion, kind, 命名空间, 资源名)，集群级资源的命名空间为None，对自动生成资源名的资源返回None
+    def get_yaml_key(self, yml):
+        name = yml['metadata'].get('name')
+        if not name:
+            return None
+        ns = self.get_yaml_namespace(yml) if self.k8s.is_namespaced(yml) else None
+        return (yml['apiVersion'], yml['kind'], ns, name)
+
+    def diff(self):
+        '''
+        对比渲染的资源与集群中的资源: 每个资源类型+命名空间只调用一次按app标签过滤的list api，在内存中做字段级对比
+            只对比渲染出的字段，忽略服务端默认值与服务端维护的字段
+        :return 有差异的资源数(含新增与多余的)
+        '''
+        ymls = self.prepare_yamls()
+        filtered = set()
+        lives = self.fetch_live_objects(ymls, True, filtered)
+        # list返回的资源没有apiVersion/kind, status由服务端维护, hash注解只是内容的摘要
+        ignores = ('apiVersion', 'kind', 'status', 'metadata.annotations.' + self.hash_annotation)
+        rendered_keys = set()
+        prefix = f"[{self.context}] " if self.context else '' # 指定集群时区分集群
+        news = changes = sames = 0
+        for type, yml in ymls:
+            key = self.get_yaml_key(yml)
+            label = self.format_yaml_key(key) if key is not None else f"{yml['apiVersion']} {yml['kind']} {yml['metadata'].get('generateName')}*"
+            if key is None or key not in lives: # 自动生成资源名 或 集群中不存在
+                news += 1
+                print(f"{prefix}+ {label}")
+                continue
+            rendered_keys.add(key)
+            diffs = diff_object(yml, lives[key], ignores)
+            if not diffs:
+                sames += 1
+                continue
+            changes += 1
+            print(f"{prefix}~ {label}")
+            for path, live, rendered in diffs:
+                print(f"{prefix}    {path}: {format_value(live)} -> {format_value(rendered)}")
+        # 集群中有(同app标签)但没有渲染的资源: 只看按app标签过滤的list结果，未过滤的(如命名空间)包含了集群中所有同类资源，不算多余
+        extras = sorted((key for key in lives.keys() - rendered_keys if key[:3] in filtered), key=str)
+        for key in extras:
+            print(f"{prefix}- {self.format_yaml_key(key)}")
+        log.info(f"{self.cluster_label()}diff汇总: 新增%s个, 变更%s个, 未变更%s个, 集群中多余%s个", news, changes, sames, len(extras))
+        return news + changes + len(extras) + self.reconcile_node_labels(True)
+
+    # 格式化资源的唯一标识，用于输出
+    def format_yaml_key(self, key):
+        api_version, kind, ns, name = key
+        return f"{api_version} {kind} {ns}/{name}" if ns else f"{api_version} {kind} {name}"
 
-    # 删除k8s资源: 使用delete api
     def delete(self):
-        self.prepare_k8s_apis()
-        for type, yml in self.yield_output_yamls():
-            name = yml['metadata']['name']
-            func = self.delete_apis[type] # 获得删除方法
-            if type == 'ns' or type == 'pv':
-                func(name=name)
+        '''
+        删除k8s资源
+            有管理者标签与app标签的资源，每个资源类型+命名空间用一次deletecollection api按标签批量删除(同时删掉这些app的过期资源)
+            其他资源(如命名空间、旧版本生成的无标签资源、不支持deletecollection的资源)用delete api逐个删除
+        '''
+        ymls = self.prepare_yamls()
+        singles = []
+        groups = {} # (apiVersion, kind, 命名空间) -> (资源类型, app集合)
+        for type, yml in ymls:
+            key = self.get_yaml_key(yml)
+            labels = yml['metadata'].get('labels') or {}
+            if key is None or key[2] is None or labels.get(self.managed_by_label) != self.managed_by or not labels.get('app') or not self.k8s.supports(yml, 'deletecollection'):
+                singles.append((type, yml))
+                continue
+            groups.setdefault(key[:3], (type, set()))[1].add(labels['app'])
+        # 每组一个批量删除任务，与单个资源一起按批次倒序删除
+        collections = []
+        for (api_version, kind, ns), (type, apps) in groups.items():
+            selector = f"{self.managed_by_label}={self.managed_by},app in ({','.join(sorted(apps))})"
+            collections.append((type, CollectionTask(api_version, kind, ns, selector)))
+
+        def delete1(type, yml):
+            if isinstance(yml, CollectionTask):
+                self.k8s.delete_collection(yml.api_version, yml.kind, yml.namespace, yml.selector)
             else:
-                func(namespace=self._ns, name=name)
-
-    # 遍历输出的yaml
-    def yield_output_yamls(self):
-        files = os.listdir(self.output_dir)
-        for file in files:
-            if file.endswith('.yml'):
-                # 解析出资源文件的类型，如demo-svc.yml的类型为svc(service)
-                mat = re.search(r"-(\w+).yml", file)
-                type = mat.group(1) # 资源类型
-                # 获得yaml
-                path = os.path.join(self.output_dir, file)
-                yml = read_yaml(path)
-                yield (type, yml)
-
-    # 准备好k8s api
-    def prepare_k8s_apis(self):
-        if self.create_apis:
+                self.delete_yaml(type, yml)
+        log.info(f"{self.cluster_label()}delete汇总: 批量删除%s组, 逐个删除%s个", len(collections), len(singles))
+        # 倒序删除
+        self.applier.run(collections + singles, delete1, 'delete', True)
+
+    # 日志中的集群前缀，指定集群时用于区分多集群执行的日志
+    def cluster_label(self):
+        return f"集群[{self.context}] " if self.context else ''
+
+    def simulate(self, nodes_file, strategy = 'spread'):
+        '''
+        离线模拟调度: 按节点快照模拟调度渲染出的所有pod副本，输出无法调度的pod及原因，每个节点的资源使用率与余量
+        :param nodes_file 节点快照文件(json/yaml)，可以是 kubectl get nodes -o json 的输出
+        :param strategy 打分策略: spread/binpack
+        :return 无法调度的pod数
+        '''
+        from K8sBoot.simulator import Simulator, PodTemplate, load_nodes, kind_replicas # 延迟导入，只有模拟才需要
+        templates = []
+        for type, yml in self.yield_yamls():
+            if yml.get('kind') in kind_replicas or yml.get('kind') == 'DaemonSet':
+                templates.append(PodTemplate(yml, self.get_yaml_namespace(yml)))
+        simulator = Simulator(load_nodes(nodes_file), strategy)
+        simulator.run(templates)
+        simulator.report()
+        return simulator.unscheduled
+
+    # 获得资源的命名空间
+    def get_yaml_namespace(self, yml):
+        return yml['metadata'].get('namespace') or self._ns or 'default'
+
+    # 遍历要应用的资源: 优先用本次渲染在内存中的资源，否则读输出目录
+    def yield_yamls(self):
+        if not self._file2objects:
+            yield from self.yield_output_yamls()
             return
-
-        config.load_kube_config()
-        core_api = client.CoreV1Api()
-        app_api = client.AppsV1Api()
-        batch_api = client.BatchV1beta1Api()
-        self.create_apis = {
-            'ns': core_api.create_namespace,
-            'pv': core_api.create_persistent_volume,
-
-            'config': core_api.create_namespaced_config_map,
-            # 'bind': core_api.create_namespaced_binding,
-            # 'endpoint': core_api.create_namespaced_endpoints,
-            # 'event': core_api.create_namespaced_event,
-            # 'limit_range': core_api.create_namespaced_limit_range,
-            'pvc': core_api.create_namespaced_persistent_volume_claim,
-            'pod': core_api.create_namespaced_pod,
-            # 'pod_bind': core_api.create_namespaced_pod_binding,
-            # 'pod_evict': core_api.create_namespaced_pod_eviction,
-            # 'pod_template': core_api.create_namespaced_pod_template,
-            'rc': core_api.create_namespaced_replication_controller,
-            # 'resource_quota': core_api.create_namespaced_resource_quota,
-            'secret': core_api.create_namespaced_secret,
-            'svc': core_api.create_namespaced_service,
-            # 'service_account': core_api.create_namespaced_service_account,
-            # 'service_account_token': core_api.create_namespaced_service_account_token,
-
-            # 'cr': app_api.create_namespaced_controller_revision,
-            'ds': app_api.create_namespaced_daemon_set,
-            'deploy': app_api.create_namespaced_deployment,
-            'rs': app_api.create_namespaced_replica_set,
-            'sts': app_api.create_namespaced_stateful_set,
-
-            'job': batch_api.create_namespaced_job,
-            'cron_job': batch_api.create_namespaced_cron_job,
-        }
-        self.patch_apis = {
-            'ns': core_api.patch_namespace,
-            'pv': core_api.patch_persistent_volume,
-
-            'config': core_api.patch_namespaced_config_map,
-            # 'bind': core_api.patch_namespaced_binding,
-            # 'endpoint': core_api.patch_namespaced_endpoints,
-            # 'event': core_api.patch_namespaced_event,
-            # 'limit_range': core_api.patch_namespaced_limit_range,
-            'pvc': core_api.patch_namespaced_persistent_volume_claim,
-            'pod': core_api.patch_namespaced_pod,
-            # 'pod_bind': core_api.patch_namespaced_pod_binding,
-            # 'pod_evict': core_api.patch_namespaced_pod_eviction,
-            # 'pod_template': core_api.patch_namespaced_pod_template,
-            'rc': core_api.patch_namespaced_replication_controller,
-            # 'resource_quota': core_api.patch_namespaced_resource_quota,
-            'secret': core_api.patch_namespaced_secret,
-            'svc': core_api.patch_namespaced_service,
-            # 'service_account': core_api.patch_namespaced_service_account,
-            # 'service_account_token': core_api.patch_namespaced_service_account_token,
-
-            # 'cr': app_api.patch_namespaced_controller_revision,
-            'ds': app_api.patch_namespaced_daemon_set,
-            'deploy': app_api.patch_namespaced_deployment,
-            'rs': app_api.patch_namespaced_replica_set,
-            'sts': app_api.patch_namespaced_stateful_set,
-
-            'job': batch_api.patch_namespaced_job,
-            'cron_job': batch_api.patch_namespaced_cron_job,
-        }
-        self.delete_apis = {
-            'ns': core_api.delete_namespace,
-            'pv': core_api.delete_persistent_volume,
-
-            'config': core_api.delete_namespaced_config_map,
-            # 'bind': core_api.delete_namespaced_binding,
-            # 'endpoint': core_api.delete_namespaced_endpoints,
-            # 'event': core_api.delete_namespaced_event,
-            # 'limit_range': core_api.delete_namespaced_limit_range,
-            'pvc': core_api.delete_namespaced_persistent_volume_claim,
-            'pod': core_api.delete_namespaced_pod,
-            # 'pod_bind': core_api.delete_namespaced_pod_binding,
-            # 'pod_evict': core_api.delete_namespaced_pod_eviction,
-            # 'pod_template': core_api.delete_namespaced_pod_template,
-            'rc': core_api.delete_namespaced_replication_controller,
-            # 'resource_quota': core_api.delete_namespaced_resource_quota,
-            'secret': core_api.delete_namespaced_secret,
-            'svc': core_api.delete_namespaced_service,
-            # 'service_account': core_api.delete_namespaced_service_account,
-            # 'service_account_token': core_api.delete_namespaced_service_account_token,
-
-            # 'cr': app_api.delete_namespaced_controller_revision,
-            'ds': app_api.delete_namespaced_daemon_set,
-            'deploy': app_api.delete_namespaced_deployment,
-            'rs': app_api.delete_namespaced_replica_set,
-            'sts': app_api.delete_namespaced_stateful_set,
-
-            'job': batch_api.delete_namespaced_job,
-            'cron_job': batch_api.delete_namespaced_cron_job,
-        }
+        for objects in self._file2objects.values():
+            yield from objects
+
+    def yield_output_yamls(self, apps = None, kinds = None):
+        '''
+        按索引遍历输出目录中的资源
+        :param apps 只遍历指定app的资源
+        :param kinds 只遍历指定kind或api资源类型的资源
+        :return 生成器，元素是(资源类型, 资源yaml)
+        '''
+        index = self.index or OutputIndex(self.output_dir)
+        index.refresh()
+        yield from index.load_objects(index.query(apps, kinds))
+
+    # 准备好k8s客户端
+    def prepare_k8s_client(self):
+        if self.k8s is None:
+            # 延迟导入: kubernetes库很大，只渲染资源文件时不需要
+            from K8sBoot.k8s_client import K8sClient
+            options = {'pool_size': self.applier.workers * 2} # 连接池要容纳并发的api调用与watch流
+            options.update(self.k8s_options)
+            self.k8s = K8sClient(metrics=self.metrics, context=self.context, **options)
+
+    def prepare_yamls(self):
+        '''
+        准备好要应用的资源，并预先解析其api(api发现不宜在多线程中并发)
+        :return 要应用的资源列表，元素是(资源类型, 资源yaml)
+        '''
+        self.prepare_k8s_client()
+        ymls = list(self.yield_yamls() if self.preloaded_yamls is None else self.preloaded_yamls)
+        for type, yml in ymls:
+            self.k8s.get_resource(yml)
+        return ymls
+
+# 等待资源就绪的默认超时(秒)，用于按app依赖分层应用
+default_wait_timeout = 300
+
+# 包装读文件的变量函数，如 ${read_file(./default.conf)}，以便记录app读取过的输入文件，用于增量渲染
+def track_input_funs():
+    for name in ('read_file', 'read_json', 'read_yaml', 'read_env', 'read_properties', 'render_file'):
+        func = sys_funcs[name]
+        if not getattr(func, 'tracked', False):
+            sys_funcs[name] = wrap_input_fun(func)
+
+def wrap_input_fun(func):
+    @wraps(func)
+    def wrapper(file, *args):
+        boot = get_var('boot', False)
+        if isinstance(boot, Boot) and not is_http_file(file):
+            boot.track_input(file)
+        return func(file, *args)
+    wrapper.tracked = True
+    return wrapper
+
+def parse_boot_options():
+    '''
+    解析K8sBoot专有的命令选项
+        pyutilb的parse_cmd()不认识这些选项，因此要先解析并从sys.argv中摘除
+    '''
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument('--incremental', action='store_true', help='Incremental rendering: skip apps whose input not changed')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of processes to render step files in parallel')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--apply', dest='k8s_action', action='store_const', const='apply', help='Apply rendered resources to k8s cluster')
+    group.add_argument('--create', dest='k8s_action', action='store_const', const='create', help='Create rendered resources in k8s cluster')
+    group.add_argument('--delete', dest='k8s_action', action='store_const', const='delete', help='Delete rendered resources from k8s cluster')
+    group.add_argument('--diff', dest='k8s_action', action='store_const', const='diff', help='Diff rendered resources against k8s cluster, exit 1 if any difference')
+    parser.add_argument('--context', action='append', help='Kubeconfig context (cluster) to apply/create/delete/diff, repeatable or comma separated to run on several clusters concurrently, default current context')
+    parser.add_argument('--fail-fast', action='store_true', help='Abort other clusters once one cluster fails, otherwise continue, only work with several --context')
+    parser.add_argument('--cluster-parallel', type=int, help='Number of clusters to run concurrently, default all, 1 means one by one in order of --context')
+    parser.add_argument('--client-side', dest='server_side', action='store_false', help='Apply by create/patch api instead of server-side apply')
+    parser.add_argument('--field-manager', default='K8sBoot', help='Field manager of server-side apply, default K8sBoot')
+    parser.add_argument('--force-conflicts', action='store_true', help='Take over fields owned by other managers on server-side apply')
+    parser.add_argument('--prune', action='store_true', help='Delete resources managed by K8sBoot but not rendered any more, only work with --apply')
+    parser.add_argument('--wait', action='store_true', help='Wait for rollout of workloads, completion of jobs and binding of pvcs, only work with --apply/--create. Without it, apps that others depend on (depends_on or references) are still waited before applying their dependents')
+    parser.add_argument('--wait-timeout', type=float, default=default_wait_timeout, help='Global timeout seconds of --wait, and of waiting for dependencies between apps, default 300')
+    parser.add_argument('--simulate', help='Simulate scheduling of rendered pods on the node snapshot file (json/yaml, e.g. output of kubectl get nodes -o json) offline, exit 1 if any pod unschedulable')
+    parser.add_argument('--simulate-strategy', choices=('spread', 'binpack'), default='spread', help='Scoring strategy of --simulate: spread (default, like kube-scheduler) or binpack')
+    parser.add_argument('--workers', type=int, help='Number of threads to call k8s api concurrently')
+    parser.add_argument('--pool-size', type=int, help='Connection pool size of k8s api client, default twice of --workers')
+    parser.add_argument('--qps', type=float, help='Max queries per second to k8s api, <=0 means no limit, default 50')
+    parser.add_argument('--burst', type=int, help='Max burst of queries to k8s api, default 100')
+    parser.add_argument('--retries', type=int, help='Max retries of k8s api call on 429/5xx/conflict, default 5')
+    parser.add_argument('--no-output', dest='write_output', action='store_false', help='Do not write resource files, only work with --apply/--create/--delete')
+    parser.add_argument('--timing', action='store_true', help='Print time cost of startup (imports) and each phase')
+    parser.add_argument('--profile', nargs='?', const='k8sboot.pstats', help='Profile actions/functions and dump cProfile stats to the file, default k8sboot.pstats')
+    parser.add_argument('--trace-malloc', action='store_true', help='Trace memory allocation peak of each app, only work with --profile')
+    parser.add_argument('--metrics', help='Write run metrics (apps, objects by kind, bytes, render time, k8s api calls) to the json file')
+    parser.add_argument('--metrics-prom', help='Write run metrics to the file in prometheus text format, for textfile collector of node_exporter')
+    option, args = parser.parse_known_args(sys.argv[1:])
+    sys.argv[1:] = args
+    option.contexts = [context.strip() for value in option.context or [] for context in value.split(',') if context.strip()]
+    return option
+
+def write_metrics(metrics, timing, boot_option):
+    '''
+    导出本次执行的指标
+    :param metrics RunMetrics
+    :param timing 各阶段耗时
+    :param boot_option K8sBoot专有的命令选项
+    '''
+    if metrics.success is None:
+        metrics.success = False
+    metrics.record_phases(timing.phases)
+    if boot_option.metrics:
+        metrics.write_json(boot_option.metrics)
+        log.info(f"指标已导出到%s", boot_option.metrics)
+    if boot_option.metrics_prom:
+        metrics.write_prom(boot_option.metrics_prom)
+        log.info(f"指标已导出到%s", boot_option.metrics_prom)
 
 # cli入口
 def main():
+    import K8sBoot
+    timing = Timing(K8sBoot.import_start)
+    timing.mark('import')
     # 读元数据：author/version/description
     dir = os.path.dirname(__file__)
     meta = read_init_file_meta(dir + os.sep + '__init__.py')
+    # K8sBoot专有的选项
+    boot_option = parse_boot_options()
     # 步骤配置的yaml
     step_files, option = parse_cmd('K8sBoot', meta['version'])
+    timing.mark('parse options')
     if len(step_files) == 0:
         raise Exception("Miss step config file or directory")
-    # 基于yaml的执行器
-    boot = Boot(option.output)
+    if not boot_option.write_output and not boot_option.k8s_action:
+        raise Exception("Option --no-output must be used with --apply/--create/--delete/--diff")
+    if boot_option.prune and boot_option.k8s_action != 'apply':
+        raise Exception("Option --prune must be used with --apply")
+    if boot_option.wait and boot_option.k8s_action not in ('apply', 'create'):
+        raise Exception("Option --wait must be used with --apply/--create")
+    if boot_option.contexts and not boot_option.k8s_action:
+        raise Exception("Option --context must be used with --apply/--create/--delete/--diff")
+    if boot_option.profile and boot_option.jobs > 1:
+        log.warning("--profile不支持多进程渲染, 将忽略--jobs")
+        boot_option.jobs = 1
+    metrics = None
     try:
-        # 执行yaml配置的步骤
-        boot.run(step_files)
-    except Exception as ex:
-        log.error(f"Exception occurs: current step file is %s", boot.step_file, exc_info=ex)
-        raise ex
+        # 多进程并行渲染: 资源在子进程中，因此要从输出目录读资源来应用
+        if boot_option.jobs > 1:
+            from K8sBoot.render_pool import RenderPool, expand_step_files # 延迟导入，只有并行渲染才需要
+        if boot_option.jobs > 1 and len(expand_step_files(step_files)) > 1:
+            if not boot_option.write_output:
+                raise Exception("Option --no-output can not be used with --jobs")
+            pool = RenderPool(option.output, boot_option.jobs, workers=boot_option.workers, incremental=boot_option.incremental, funs=option.funs)
+            metrics = pool.metrics
+            pool.run(step_files)
+            boot = Boot(option.output, workers=boot_option.workers)
+            boot.metrics = metrics
+            boot.app2deps = pool.app2deps
+            boot.node2labels = pool.node2labels
+            boot.prune = boot_option.prune
+            boot.server_side = boot_option.server_side
+            boot.field_manager = boot_option.field_manager
+            boot.force_conflicts = boot_option.force_conflicts
+            boot.wait = boot_option.wait
+            boot.wait_timeout = boot_option.wait_timeout
+        else:
+            # 基于yaml的执行器
+            boot = Boot(option.output, workers=boot_option.workers, incremental=boot_option.incremental, write_output=boot_option.write_output)
+            boot.k8s_action = boot_option.k8s_action
+            boot.prune = boot_option.prune
+            boot.server_side = boot_option.server_side
+            boot.field_manager = boot_option.field_manager
+            boot.force_conflicts = boot_option.force_conflicts
+            boot.wait = boot_option.wait
+            boot.wait_timeout = boot_option.wait_timeout
+            metrics = boot.metrics
+            # 性能剖析
+            if boot_option.profile:
+                from K8sBoot.profiler import Profiler
+                profiler = Profiler(boot_option.trace_malloc)
+                profiler.attach(boot)
+                profiler.start()
+            try:
+                # 执行yaml配置的步骤
+                boot.run(step_files)
+            except Exception as ex:
+                log.error(f"Exception occurs: current step file is %s", boot.step_file, exc_info=ex)
+                raise ex
+        timing.mark('render')
+        # 直接应用到集群
+        if boot_option.k8s_action:
+            boot.k8s_options = {key: getattr(boot_option, key) for key in ('pool_size', 'qps', 'burst', 'retries') if getattr(boot_option, key) is not None}
+            if len(boot_option.contexts) > 1: # 多集群并发执行
+                from K8sBoot.multi_cluster import MultiClusterRunner
+                runner = MultiClusterRunner(boot, boot_option.contexts, boot_option.fail_fast, boot_option.cluster_parallel)
+                ndiff = runner.run(boot_option.k8s_action)
+            else:
+                if boot_option.contexts:
+                    boot.context = boot_option.contexts[0]
+                boot.prepare_k8s_client()
+                timing.mark('k8s client')
+                ndiff = getattr(boot, boot_option.k8s_action)()
+            timing.mark(boot_option.k8s_action)
+        # 离线模拟调度
+        if boot_option.simulate:
+            nunscheduled = boot.simulate(boot_option.simulate, boot_option.simulate_strategy)
+            timing.mark('simulate')
+        metrics.success = True
+    finally:
+        # 失败时也导出指标，以便监控到失败
+        if metrics is not None and (boot_option.metrics or boot_option.metrics_prom):
+            write_metrics(metrics, timing, boot_option)
+    if boot_option.profile:
+        profiler.stop()
+        profiler.report()
+        profiler.dump_stats(boot_option.profile)
+        log.info(f"性能剖析结果已导出到%s, 可用 python -m pstats %s 查看", boot_option.profile, boot_option.profile)
+    if boot_option.timing:
+        timing.report()
+    # 与kubectl diff一样，有差异则退出码为1
+    if boot_option.k8s_action == 'diff' and ndiff:
+        sys.exit(1)
+    # 有pod无法调度则退出码为1
+    if boot_option.simulate and nunscheduled:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import json
+
+'''
+渲染资源与集群中资源的字段级对比
+    只对比渲染资源中有的字段: 集群中多出的字段(服务端默认值如protocol/imagePullPolicy, 服务端维护的uid/resourceVersion/status等)都忽略
+    元素都有name的list(如containers/env/volumes)按name匹配，其他list按下标匹配
+    资源量(如cpu: 0.1 与 100m)按数值对比
+'''
+
+# 资源量所在的key，其值按数值对比
+quantity_keys = ('limits', 'requests', 'capacity', 'storage')
+
+# 值是否为空: 服务端会丢掉空值
+def is_empty(value):
+    return value is None or value == {} or value == [] or value == ''
+
+# list的元素是否都有name，有则按name匹配
+def is_named_list(items):
+    return len(items) > 0 and all(isinstance(item, dict) and 'name' in item for item in items)
+
+def is_same_quantity(a, b):
+    from kubernetes.utils import parse_quantity # 延迟导入: 只有对比集群资源时才需要
+    try:
+        return parse_quantity(a) == parse_quantity(b)
+    except ValueError:
+        return False
+
+def diff_object(rendered, live, ignores = (), path = '', in_quantity = False):
+    '''
+    对比渲染资源与集群中的资源
+    :param rendered 渲染的资源(或其字段值)
+    :param live 集群中的资源(或其字段值)
+    :param ignores 忽略的字段路径，如 metadata.annotations.k8sboot/hash
+    :param path 当前字段路径
+    :param in_quantity 当前值是否为资源量
+    :return 差异列表，元素是(字段路径, 集群中的值, 渲染的值)，集群中没有的值为None
+    '''
+    if path in ignores:
+        return []
+    if isinstance(rendered, dict):
+        if not isinstance(live, dict):
+            return [] if is_empty(rendered) and is_empty(live) else [(path, live, rendered)]
+        ret = []
+        for key, value in rendered.items():
+            sub = f"{path}.{key}" if path else str(key)
+            if sub in ignores:
+                continue
+            if key not in live or live[key] is None:
+                if not is_empty(value):
+                    ret.append((sub, None, value))
+                continue
+            ret.extend(diff_object(value, live[key], ignores, sub, in_quantity or key in quantity_keys))
+        return ret
+    if isinstance(rendered, list):
+        if not isinstance(live, list):
+            return [] if is_empty(rendered) and is_empty(live) else [(path, live, rendered)]
+        return diff_list(rendered, live, ignores, path, in_quantity)
+    # 标量
+    if rendered == live or is_empty(rendered) and is_empty(live):
+        return []
+    if in_quantity and isinstance(live, str) and is_same_quantity(str(rendered), live):
+        return []
+    return [(path, live, rendered)]
+
+def diff_list(rendered, live, ignores, path, in_quantity):
+    '''
+    对比list: 元素都有name则按name匹配(集群中多出的元素也算差异)，否则按下标匹配
+    '''
+    if is_named_list(rendered) and is_named_list(live):
+        ret = []
+        name2live = {item['name']: item for item in live}
+        for item in rendered:
+            sub = f"{path}[name={item['name']}]"
+            if item['name'] not in name2live:
+                ret.append((sub, None, item))
+            else:
+                ret.extend(diff_object(item, name2live[item['name']], ignores, sub, in_quantity))
+        names = {item['name'] for item in rendered}
+        for item in live:
+            if item['name'] not in names:
+                ret.append((f"{path}[name={item['name']}]", item, None))
+        return ret
+    # 标量list(如command/args)整体对比
+    if not any(isinstance(item, (dict, list)) for item in rendered):
+        return [] if rendered == live else [(path, live, rendered)]
+    if len(rendered) != len(live):
+        return [(path, live, rendered)]
+    ret = []
+    for i, item in enumerate(rendered):
+        ret.extend(diff_object(item, live[i], ignores, f"{path}[{i}]", in_quantity))
+    return ret
+
+# 格式化字段值，用于输出差异
+def format_value(value):
+    if value is None:
+        return '<none>'
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False, sort_keys=True)
+    return str(value)
@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from kubernetes import client, config
+from kubernetes.dynamic import DynamicClient
+from kubernetes.dynamic.exceptions import DynamicApiError, ResourceNotFoundError
+from pyutilb.log import log
+from K8sBoot.rate_limiter import TokenBucket
+
+# 内置资源用strategic merge patch，自定义资源(CRD)不支持，只能用merge patch
+builtin_groups = ('', 'apps', 'batch', 'autoscaling', 'networking.k8s.io', 'policy', 'rbac.authorization.k8s.io', 'storage.k8s.io')
+
+# 非幂等的动作(POST): 服务端可能已经提交了才返回5xx，重试会重复创建(generateName)或报AlreadyExists
+unsafe_verbs = ('create',)
+
+# 集群不支持的资源类型
+class UnsupportedResourceError(Exception):
+    pass
+
+'''
+通用的k8s资源客户端: 通过api发现(discovery)解析任意 apiVersion+kind 对应的api路径，而不用为每种资源写死类型化的api方法
+    发现结果缓存在 ~/.kube/cache/k8sboot/ 下(每个集群一个文件)，超过有效期才重新发现；有效期内遇到未知的kind也会自动刷新缓存
+    所有线程共用一个连接池与一个令牌桶限流器(同client-go的QPS/burst)，遇到429/5xx/冲突则按指数退避+抖动重试，并遵循Retry-After
+'''
+class K8sClient(object):
+
+    # 发现缓存的有效期(秒)，与kubectl的发现缓存一样为6小时
+    discovery_ttl = 6 * 3600
+    # 默认的限流: 每秒请求数与突发请求数
+    default_qps = 50
+    default_burst = 100
+    # 默认的最大重试次数
+    default_retries = 5
+    # 重试的退避时间(秒): 初始值与上限
+    backoff_base = 0.5
+    backoff_max = 30
+
+    def __init__(self, cache_dir = None, ttl = None, metrics = None, pool_size = None, qps = None, burst = None, retries = None, context = None):
+        '''
+        :param cache_dir 发现缓存的目录
+        :param ttl 发现缓存的有效期(秒)
+        :param metrics RunMetrics，记录api调用的次数、耗时、错误、重试与限流等待
+        :param pool_size 连接池大小，应不小于并发调用api的线程数，否则多出的连接用完即弃
+        :param qps 每秒请求数，<=0表示不限流
+        :param burst 突发请求数
+        :param retries 最大重试次数
+        :param context kubeconfig中的上下文(集群)，默认为当前上下文
+        '''
+        self.metrics = metrics
+        self.context = context
+        # 每个客户端有自己的配置，而不是改全局默认配置，以便同时连接多个集群
+        configuration = client.Configuration()
+        config.load_kube_config(context=context, client_configuration=configuration)
+        if pool_size:
+            configuration.connection_pool_maxsize = int(pool_size)
+        api_client = client.ApiClient(configuration)
+        self.limiter = TokenBucket(self.default_qps if qps is None else qps, burst or self.default_burst)
+        self.retries = self.default_retries if retries is None else int(retries)
+        cache_dir = cache_dir or os.path.join(os.path.expanduser('~'), '.kube', 'cache', 'k8sboot')
+        os.makedirs(cache_dir, exist_ok=True)
+        host = api_client.configuration.host
+        self.cache_file = os.path.join(cache_dir, f"discovery-{hashlib.md5(host.encode('utf-8')).hexdigest()}.json")
+        self.expire_cache(ttl or self.discovery_ttl)
+        start = time.time()
+        self.client = DynamicClient(api_client, cache_file=self.cache_file) # 默认用LazyDiscoverer: 按需发现group version
+        log.debug(f"初始化k8s客户端耗时%.3f秒, 发现缓存: %s", time.time() - start, self.cache_file)
+        self._resources = {} # 已解析的资源: (apiVersion, kind) -> Resource
+        self._lock = threading.Lock() # 发现会写缓存文件，要串行
+
+    # 删除过期的发现缓存
+    def expire_cache(self, ttl):
+        try:
+            if time.time() - os.path.getmtime(self.cache_file) > ttl:
+                log.debug(f"发现缓存已过期: %s", self.cache_file)
+                os.remove(self.cache_file)
+        except OSError: # 文件不存在
+            pass
+
+    def get_resource(self, yml):
+        '''
+        解析资源的api
+        :param yml 资源yaml
+        :return kubernetes.dynamic.Resource
+        '''
+        key = (yml['apiVersion'], yml['kind'])
+        with self._lock:
+            if key not in self._resources:
+                try:
+                    self._resources[key] = self.client.resources.get(api_version=key[0], kind=key[1])
+                except ResourceNotFoundError as ex:
+                    raise UnsupportedResourceError(f"集群不支持资源类型: apiVersion={key[0]}, kind={key[1]}") from ex
+            return self._resources[key]
+
+    def call(self, verb, kind, func, **kwargs):
+        '''
+        调用api: 先限流，失败可重试的则退避后重试，并记录指标
+        :param verb 动作: create/patch/delete/list
+        :param kind 资源kind
+        :param func DynamicClient的方法
+        '''
+        attempt = 0
+        while True:
+            self.throttle(verb, kind)
+            start = time.perf_counter()
+            try:
+                ret = func(**kwargs)
+                self.record_api(verb, kind, start, True)
+                return ret
+            except DynamicApiError as ex:
+                self.record_api(verb, kind, start, False)
+                delay = self.get_retry_delay(ex, attempt, verb)
+                if delay is None or attempt >= self.retries:
+                    raise
+                attempt += 1
+                log.debug(f"%s %s失败(%s), %.2f秒后第%s次重试", verb, kind, ex.status, delay, attempt)
+                if self.metrics is not None:
+                    self.metrics.record_retry(verb, kind)
+                time.sleep(delay)
+
+    # 限流: 等待令牌
+    def throttle(self, verb, kind):
+        wait = self.limiter.acquire()
+        if wait and self.metrics is not None:
+            self.metrics.record_throttle(wait)
+
+    def record_api(self, verb, kind, start, ok):
+        if self.metrics is not None:
+            self.metrics.record_api(verb, kind, time.perf_counter() - start, ok)
+
+    def get_retry_delay(self, ex, attempt, verb):
+        '''
+        获得重试前的等待时间
+            429(限流)/5xx(服务端错误，除了501)/409的乐观锁冲突 可重试，但server-side apply的字段冲突重试也没用
+            非幂等的create只在429或有Retry-After响应头(服务端明确未处理)时重试
+            有Retry-After响应头则按其等待，否则指数退避+抖动
+        :param ex api异常
+        :param attempt 已重试的次数
+        :param verb 动作
+        :return 等待秒数，不可重试则为None
+        '''
+        status = ex.status or 0
+        retry_after = (ex.headers or {}).get('Retry-After')
+        if verb in unsafe_verbs and status != 429 and not retry_after:
+            return None
+        if status == 409:
+            body = self.parse_error_body(ex)
+            causes = (body.get('details') or {}).get('causes') or []
+            if body.get('reason') != 'Conflict' or any(cause.get('type') == 'FieldManagerConflict' for cause in causes):
+                return None
+        elif status != 429 and (status < 500 or status == 501):
+            return None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError: # 也可能是http日期，忽略
+                pass
+        delay = min(self.backoff_base * 2 ** attempt, self.backoff_max)
+        return delay * random.uniform(0.5, 1.5)
+
+    # 解析api错误的响应体(Status对象)
+    def parse_error_body(self, ex):
+        try:
+            return json.loads(ex.body) or {}
+        except (TypeError, ValueError):
+            return {}
+
+    def has_resource(self, api_version, kind):
+        '''
+        集群是否支持资源类型
+        :param api_version 资源的apiVersion
+        :param kind 资源的kind
+        '''
+        try:
+            self.get_resource({'apiVersion': api_version, 'kind': kind})
+            return True
+        except UnsupportedResourceError:
+            return False
+
+    # 资源是否支持指定的api动作，如deletecollection
+    def supports(self, yml, verb):
+        return verb in (self.get_resource(yml).verbs or [])
+
+    # 是否命名空间级的资源
+    def is_namespaced(self, yml):
+        return self.get_resource(yml).namespaced
+
+    def create(self, yml, namespace):
+        '''
+        创建资源
+        :param yml 资源yaml
+        :param namespace 命名空间，资源中没指定命名空间时用
+        '''
+        res = self.get_resource(yml)
+        return self.call('create', yml['kind'], self.client.create, resource=res, body=yml, namespace=namespace if res.namespaced else None)
+
+    def patch(self, yml, namespace):
+        '''
+        更新资源
+        :param yml 资源yaml
+        :param namespace 命名空间，资源中没指定命名空间时用
+        '''
+        res = self.get_resource(yml)
+        content_type = 'application/strategic-merge-patch+json' if res.group in builtin_groups else 'application/merge-patch+json'
+        return self.call('patch', yml['kind'], self.client.patch, resource=res, body=yml, namespace=namespace if res.namespaced else None, content_type=content_type)
+
+    def apply(self, yml, namespace, field_manager, force = False):
+        '''
+        服务端应用(server-side apply): 不存在则创建，存在则由服务端按字段归属合并，只更新本管理者拥有的字段
+            资源dict直接作为apply-patch+yaml的请求体(json是yaml的子集)，不经过类型化模型的转换
+        :param yml 资源yaml
+        :param namespace 命名空间，资源中没指定命名空间时用
+        :param field_manager 字段管理者
+        :param force 字段被其他管理者拥有时，是否强制接管
+        '''
+        res = self.get_resource(yml)
+        return self.call('apply', yml['kind'], self.client.server_side_apply, resource=res, body=yml, namespace=namespace if res.namespaced else None, field_manager=field_manager, force_conflicts=force or None)
+
+    def delete(self, yml, namespace):
+        '''
+        删除资源
+        :param yml 资源yaml
+        :param namespace 命名空间，资源中没指定命名空间时用
+        '''
+        res = self.get_resource(yml)
+        return self.call('delete', yml['kind'], self.client.delete, resource=res, name=yml['metadata']['name'], namespace=namespace if res.namespaced else None)
+
+    def delete_collection(self, api_version, kind, namespace, label_selector):
+        '''
+        按标签选择器批量删除资源(deletecollection)，一次api调用删除多个资源
+        :param api_version 资源的apiVersion
+        :param kind 资源的kind
+        :param namespace 命名空间，集群级资源为None
+        :param label_selector 标签选择器
+        '''
+        res = self.get_resource({'apiVersion': api_version, 'kind': kind})
+        return self.call('deletecollection', kind, self.client.delete, resource=res, namespace=namespace if res.namespaced else None, label_selector=label_selector)
+
+    def watch(self, api_version, kind, namespace, label_selector = None, timeout = None):
+        '''
+        监听资源的变化: 先推送现有资源(ADDED事件)，之后推送变化，直到超时
+        :param api_version 资源的apiVersion
+        :param kind 资源的kind
+        :param namespace 命名空间，集群级资源为None
+        :param label_selector 标签选择器
+        :param timeout 超时(秒)，由服务端结束watch流
+        :return 生成器，元素是事件dict: type为ADDED/MODIFIED/DELETED/ERROR, raw_object为资源dict
+        '''
+        res = self.get_resource({'apiVersion': api_version, 'kind': kind})
+        self.throttle('watch', kind)
+        start = time.perf_counter()
+        ok = True
+        try:
+            yield from self.client.watch(res, namespace=namespace if res.namespaced else None, label_selector=label_selector, timeout=timeout)
+        except Exception:
+            ok = False
+            raise
+        finally: # 调用方提前结束监听也算成功
+            if self.metrics is not None:
+                self.metrics.record_api('watch', kind, time.perf_counter() - start, ok)
+
+    def list(self, api_version, kind, namespace = None, label_selector = None):
+        '''
+        列出资源
+        :param api_version 资源的apiVersion
+        :param kind 资源的kind
+        :param namespace 命名空间，集群级资源为None
+        :param label_selector 标签选择器，如 app in (a,b)
+        :return 资源列表，元素是dict
+        '''
+        res = self.get_resource({'apiVersion': api_version, 'kind': kind})
+        return self.call('list', kind, self.client.get, resource=res, namespace=namespace, label_selector=label_selector).to_dict().get('items') or []
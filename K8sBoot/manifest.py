@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+from pyutilb.log import log
+from K8sBoot.yaml_io import write_file_if_changed
+
+# 获得文件的签名: 内容的md5，文件不存在则为None
+# 注: 不用修改时间，因为签名保存在输出目录中，重新检出(如CI恢复)后修改时间变了而内容没变，不能导致清单与索引被改写
+def get_file_sign(path):
+    md5 = hashlib.md5()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+    except OSError:
+        return None
+    return md5.hexdigest()
+
+# 渲染逻辑的版本: 渲染结果有变化(如新增标签/注解)时要加1，使旧的增量清单失效
+render_schema = 1
+
+# 渲染器的版本: K8sBoot版本+渲染逻辑版本，与上次渲染时不同则全量渲染
+def get_render_version():
+    from K8sBoot import __version__ # 延迟导入: 包的__init__先导入boot再定义版本
+    return f"{__version__}-{render_schema}"
+
+# 计算任意数据的指纹: 不能json序列化的对象(如boot变量)只取类型名
+def build_fingerprint(data):
+    txt = json.dumps(data, sort_keys=True, ensure_ascii=False, default=lambda o: type(o).__name__)
+    return hashlib.md5(txt.encode('utf-8')).hexdigest()
+
+'''
+增量渲染的清单，保存在输出目录下的 .k8sboot-manifest.json
+    记录渲染器的版本，以及每个app的输入指纹(步骤+变量+命名空间+渲染器版本)、读取过的输入文件签名、引用的其他app的端口签名、生成的资源文件、以及跨app共享的端口状态
+    下次渲染时，如果app的指纹、输入文件与引用的app都没变，且资源文件都还在，则跳过该app；渲染器版本变了则整个清单失效
+'''
+class Manifest(object):
+
+    file_name = '.k8sboot-manifest.json'
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, self.file_name)
+        self.last_apps = self.load() # 上次渲染的app记录
+        self.apps = {} # 本次渲染的app记录
+
+    # 加载上次的清单
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r', encoding="utf-8") as f:
+                data = json.load(f)
+            version = get_render_version()
+            if data.get('version') != version:
+                log.info(f"渲染器版本变更(%s -> %s), 将全量渲染", data.get('version'), version)
+                return {}
+            apps = data.get('apps', {})
+            # 兼容旧版清单
+            for rec in apps.values():
+                rec.setdefault('refs', {})
+                rec['state'].setdefault('deps', [])
+            return apps
+        except Exception as ex:
+            log.warning(f"增量清单[%s]已损坏, 将全量渲染: %s", self.path, ex)
+            return {}
+
+    def is_fresh(self, app, fingerprint, build_ref_sign):
+        '''
+        检查app是否未变更
+        :param app 应用名
+        :param fingerprint 应用的输入指纹
+        :param build_ref_sign 获得被引用app的端口状态签名的函数
+        '''
+        rec = self.last_apps.get(app)
+        if rec is None or rec['fingerprint'] != fingerprint:
+            return False
+        # 输入文件有变化，签名为None表示记录时文件不存在，视为有变化
+        for path, sign in rec['inputs'].items():
+            if sign is None or get_file_sign(path) != sign:
+                return False
+        # 引用的其他app的端口有变化
+        for ref, sign in rec['refs'].items():
+            if build_ref_sign(ref) != sign:
+                return False
+        # 资源文件被删了
+        for file in rec['files']:
+            if not os.path.exists(os.path.join(self.output_dir, file)):
+                return False
+        return True
+
+    # 沿用上次的记录，返回该记录
+    def keep(self, app):
+        rec = self.last_apps[app]
+        self.apps[app] = rec
+        return rec
+
+    def record(self, app, fingerprint, inputs, files, state, refs):
+        '''
+        记录本次渲染的app
+        :param app 应用名
+        :param fingerprint 应用的输入指纹
+        :param inputs 读取过的输入文件
+        :param files 生成的资源文件名
+        :param state 跨app共享的状态，跳过app时要恢复
+        :param refs 引用的其他app的端口状态签名
+        '''
+        self.apps[app] = {
+            'fingerprint': fingerprint,
+            'inputs': {path: get_file_sign(path) for path in sorted(inputs)},
+            'files': sorted(files),
+            'state': state,
+            'refs': refs,
+        }
+
+    def clean_stale_files(self, written_files):
+        '''
+        删除过期的资源文件: 上次生成而本次没有生成(含被移除的app)的文件
+        :param written_files 本次生成的所有文件名
+        '''
+        keeps = set(written_files)
+        for rec in self.apps.values():
+            keeps.update(rec['files'])
+        for rec in self.last_apps.values():
+            for file in rec['files']:
+                path = os.path.join(self.output_dir, file)
+                if file not in keeps and os.path.exists(path):
+                    log.info(f"删除过期的资源文件: %s", path)
+                    os.remove(path)
+                    keeps.add(file)
+
+    # 保存本次的清单
+    def save(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        txt = json.dumps({'version': get_render_version(), 'apps': self.apps}, sort_keys=True, ensure_ascii=False, indent=1)
+        write_file_if_changed(self.path, txt)
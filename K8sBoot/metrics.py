@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+import time
+from K8sBoot.yaml_io import write_file_if_changed
+
+# 转义prometheus标签值
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+'''
+单次执行的指标: 渲染的app数与耗时、各kind的资源数、字节数、各阶段耗时、k8s api的调用次数/耗时/错误数
+    可导出为json，或node_exporter的textfile collector所用的prometheus文本格式(*.prom)
+'''
+class RunMetrics(object):
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.success = None # 是否执行成功，未结束为None
+        self.app_seconds = {} # 每个app的渲染耗时(秒)
+        self.skipped_apps = [] # 增量渲染跳过的app
+        self.app_ready_seconds = {} # 每个app应用到集群后的就绪耗时(秒)，用于--wait
+        self.kind2objects = {} # 每个kind的资源数
+        self.bytes = {'rendered': 0, 'written': 0} # 生成的资源文件字节数，written只含有变化而真正写入的
+        self.phase_seconds = {} # 各阶段耗时(秒)
+        self.api_calls = {} # k8s api调用: (动作, kind) -> {'count', 'errors', 'retries', 'seconds', 'max_seconds'}
+        self.throttled_seconds = 0.0 # 调用api前被限流等待的总时间(秒)
+        self.clusters = {} # 多集群执行时每个集群的汇总: 上下文 -> {'success', 'seconds', 'api_calls', 'api_errors', 'api_retries', 'app_ready_seconds'}
+        self._lock = threading.Lock() # 应用资源时会多线程调用api
+
+    def record_app(self, app, seconds):
+        self.app_seconds[app] = seconds
+
+    def record_skipped_app(self, app):
+        self.skipped_apps.append(app)
+
+    def record_app_ready(self, app, seconds):
+        self.app_ready_seconds[app] = seconds
+
+    def record_object(self, kind):
+        self.kind2objects[kind] = self.kind2objects.get(kind, 0) + 1
+
+    def record_file(self, size, written):
+        '''
+        记录生成的资源文件
+        :param size 文件字节数
+        :param written 是否真正写入(内容有变化)
+        '''
+        self.bytes['rendered'] += size
+        if written:
+            self.bytes['written'] += size
+
+    def record_phases(self, phases):
+        '''
+        记录各阶段耗时
+        :param phases [(阶段名, 耗时秒数)]，来自Timing
+        '''
+        for phase, seconds in phases:
+            self.phase_seconds[phase] = self.phase_seconds.get(phase, 0) + seconds
+
+    def record_api(self, verb, kind, seconds, ok):
+        '''
+        记录k8s api调用
+        :param verb 动作: create/patch/delete/list
+        :param kind 资源kind
+        :param seconds 耗时
+        :param ok 是否成功
+        '''
+        with self._lock:
+            stat = self.get_api_stat(verb, kind)
+            stat['count'] += 1
+            stat['seconds'] += seconds
+            stat['max_seconds'] = max(stat['max_seconds'], seconds)
+            if not ok:
+                stat['errors'] += 1
+
+    # 记录api调用的重试
+    def record_retry(self, verb, kind):
+        with self._lock:
+            self.get_api_stat(verb, kind)['retries'] += 1
+
+    # 记录限流等待的时间
+    def record_throttle(self, seconds):
+        with self._lock:
+            self.throttled_seconds += seconds
+
+    def record_cluster(self, context, success, seconds, metrics):
+        '''
+        记录单个集群的执行结果，并将其api调用汇总到总数中
+        :param context 集群上下文
+        :param success 是否成功
+        :param seconds 耗时
+        :param metrics 该集群的RunMetrics
+        '''
+        with self._lock:
+            stats = metrics.api_calls.values()
+            self.clusters[context] = {
+                'success': success,
+                'seconds': seconds,
+                'api_calls': sum(stat['count'] for stat in stats),
+                'api_errors': sum(stat['errors'] for stat in stats),
+                'api_retries': sum(stat['retries'] for stat in stats),
+                'app_ready_seconds': metrics.app_ready_seconds,
+            }
+            for (verb, kind), stat in metrics.api_calls.items():
+                total = self.get_api_stat(verb, kind)
+                for key in ('count', 'errors', 'retries', 'seconds'):
+                    total[key] += stat[key]
+                total['max_seconds'] = max(total['max_seconds'], stat['max_seconds'])
+            self.throttled_seconds += metrics.throttled_seconds
+
+    def get_api_stat(self, verb, kind):
+        return self.api_calls.setdefault((verb, kind), {'count': 0, 'errors': 0, 'retries': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+
+    def merge(self, data):
+        '''
+        合并其他进程的渲染指标，用于并行渲染
+        :param data 其他进程的to_dict()结果
+        '''
+        self.app_seconds.update(data['app_seconds'])
+        self.skipped_apps.extend(data['skipped_apps'])
+        for kind, count in data['objects'].items():
+            self.kind2objects[kind] = self.kind2objects.get(kind, 0) + count
+
+    def to_dict(self):
+        return {
+            'start_time': self.start_time,
+            'success': self.success,
+            'apps': len(self.app_seconds) + len(self.skipped_apps),
+            'app_seconds': self.app_seconds,
+            'skipped_apps': self.skipped_apps,
+            'app_ready_seconds': self.app_ready_seconds,
+            'objects': self.kind2objects,
+            'bytes': self.bytes,
+            'phase_seconds': self.phase_seconds,
+            'throttled_seconds': self.throttled_seconds,
+            'api_calls': [dict(stat, verb=verb, kind=kind) for (verb, kind), stat in sorted(self.api_calls.items())],
+            'clusters': self.clusters,
+        }
+
+    def write_json(self, path):
+        write_file_if_changed(path, json.dumps(self.to_dict(), indent=1, sort_keys=True, ensure_ascii=False))
+
+    def write_prom(self, path):
+        '''
+        写prometheus文本格式的指标文件，供node_exporter的textfile collector采集
+            先写临时文件再改名，以免采集到写了一半的文件
+        '''
+        lines = []
+        def add(name, type, help, samples):
+            lines.append(f"# HELP k8sboot_{name} {help}")
+            lines.append(f"# TYPE k8sboot_{name} {type}")
+            for labels, value in samples:
+                label = ','.join(f'{key}="{escape_label(val)}"' for key, val in labels.items())
+                lines.append(f"k8sboot_{name}{{{label}}} {value}" if label else f"k8sboot_{name} {value}")
+        add('last_run_timestamp_seconds', 'gauge', 'Start time of the last run', [({}, self.start_time)])
+        add('last_run_success', 'gauge', 'Whether the last run succeeded', [({}, 1 if self.success else 0)])
+        add('apps', 'gauge', 'Number of apps in the last run', [({'state': 'rendered'}, len(self.app_seconds)), ({'state': 'skipped'}, len(self.skipped_apps))])
+        add('objects', 'gauge', 'Number of rendered objects by kind', [({'kind': kind}, count) for kind, count in sorted(self.kind2objects.items())])
+        add('bytes', 'gauge', 'Bytes of resource files, written only counts changed files', [({'type': type}, size) for type, size in self.bytes.items()])
+        add('app_render_seconds', 'gauge', 'Render time of each app', [({'app': app}, seconds) for app, seconds in sorted(self.app_seconds.items())])
+        add('app_ready_seconds', 'gauge', 'Time to ready of each app after applied', [({'app': app}, seconds) for app, seconds in sorted(self.app_ready_seconds.items())])
+        add('phase_seconds', 'gauge', 'Time of each phase', [({'phase': phase}, seconds) for phase, seconds in self.phase_seconds.items()])
+        calls = sorted(self.api_calls.items())
+        add('api_calls', 'gauge', 'Number of k8s api calls', [({'verb': verb, 'kind': kind}, stat['count']) for (verb, kind), stat in calls])
+        add('api_errors', 'gauge', 'Number of failed k8s api calls', [({'verb': verb, 'kind': kind}, stat['errors']) for (verb, kind), stat in calls])
+        add('api_retries', 'gauge', 'Number of retries of k8s api calls', [({'verb': verb, 'kind': kind}, stat['retries']) for (verb, kind), stat in calls])
+        add('api_throttled_seconds', 'gauge', 'Time waited by client side rate limiting', [({}, self.throttled_seconds)])
+        add('api_seconds_sum', 'gauge', 'Total latency of k8s api calls', [({'verb': verb, 'kind': kind}, stat['seconds']) for (verb, kind), stat in calls])
+        add('api_seconds_max', 'gauge', 'Max latency of k8s api calls', [({'verb': verb, 'kind': kind}, stat['max_seconds']) for (verb, kind), stat in calls])
+        clusters = sorted(self.clusters.items())
+        add('cluster_success', 'gauge', 'Whether the run succeeded on each cluster', [({'cluster': context}, 1 if item['success'] else 0) for context, item in clusters])
+        add('cluster_seconds', 'gauge', 'Time of the run on each cluster', [({'cluster': context}, item['seconds']) for context, item in clusters])
+        write_file_if_changed(path, '\n'.join(lines) + '\n')
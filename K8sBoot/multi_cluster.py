@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import copy
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pyutilb.log import log
+from K8sBoot.applier import Applier
+from K8sBoot.metrics import RunMetrics
+
+'''
+单个集群的执行报告
+'''
+class ClusterReport(object):
+
+    def __init__(self, context):
+        self.context = context # 集群上下文
+        self.status = 'skipped' # 状态: ok/failed/skipped
+        self.seconds = 0.0 # 耗时(秒)
+        self.result = None # 动作的返回值，如diff的差异数
+        self.error = None # 失败的异常
+        self.metrics = None # 该集群的RunMetrics
+
+    def __str__(self):
+        if self.status == 'skipped':
+            return f"集群[{self.context}]: 已跳过"
+        calls = self.metrics.api_calls.values()
+        ret = f"集群[{self.context}]: {'成功' if self.status == 'ok' else '失败'}, 耗时{self.seconds:.1f}秒, api调用{sum(stat['count'] for stat in calls)}次(错误{sum(stat['errors'] for stat in calls)}次, 重试{sum(stat['retries'] for stat in calls)}次)"
+        if self.metrics.app_ready_seconds:
+            ret += f", 就绪耗时{max(self.metrics.app_ready_seconds.values()):.1f}秒"
+        if self.error is not None:
+            ret += f", 错误: {self.error}"
+        return ret
+
+'''
+多集群执行器: 将同一份渲染结果并发地应用(或创建/删除/对比)到kubeconfig中的多个上下文(集群)
+    每个集群一个Boot的浅拷贝，有各自的k8s客户端(连接池+限流器)、应用器与指标，共享只读的渲染资源(只加载一次)
+    失败隔离: fail_fast则一个集群失败后中止其他集群(未开始的跳过，执行中的不再执行后续批次)，否则其他集群继续执行
+'''
+class MultiClusterRunner(object):
+
+    def __init__(self, boot, contexts, fail_fast = False, parallel = None):
+        '''
+        :param boot 已渲染资源的Boot
+        :param contexts 集群上下文列表
+        :param fail_fast 是否一个集群失败就中止其他集群
+        :param parallel 并发执行的集群数，默认全部并发；为1则按顺序逐个集群执行，如先dev后prod
+        '''
+        self.boot = boot
+        self.contexts = contexts
+        self.fail_fast = fail_fast
+        self.parallel = int(parallel or len(contexts))
+        self.abort = threading.Event()
+        self.reports = {context: ClusterReport(context) for context in contexts}
+
+    def run(self, action):
+        '''
+        在所有集群上执行动作
+        :param action 动作: apply/create/delete/diff
+        :return 动作在各集群的返回值之和，如diff的总差异数
+        '''
+        self.boot.preloaded_yamls = list(self.boot.yield_yamls())
+        with ThreadPoolExecutor(self.parallel) as pool:
+            futures = [pool.submit(self.run_1cluster, self.fork(context), action) for context in self.contexts]
+            for future in futures:
+                future.result()
+        self.report(action)
+        bads = [context for context, report in self.reports.items() if report.status != 'ok']
+        if bads:
+            raise Exception(f"{action}失败的集群: {', '.join(bads)}")
+        return sum(report.result or 0 for report in self.reports.values())
+
+    def fork(self, context):
+        '''
+        为集群复制Boot: 共享渲染结果，k8s客户端/应用器/指标是集群专有的
+        :param context 集群上下文
+        '''
+        boot = copy.copy(self.boot)
+        boot.context = context
+        boot.k8s = None
+        boot.metrics = RunMetrics()
+        boot.applier = Applier(self.boot.applier.workers, context, self.abort)
+        return boot
+
+    def run_1cluster(self, boot, action):
+        '''
+        在单个集群上执行动作，失败不影响其他集群(除非fail_fast)
+        :param boot 该集群的Boot
+        :param action 动作
+        '''
+        report = self.reports[boot.context]
+        report.metrics = boot.metrics
+        if self.abort.is_set(): # fail_fast: 其他集群已失败
+            self.boot.metrics.record_cluster(boot.context, False, 0.0, boot.metrics)
+            return
+        start = time.time()
+        try:
+            boot.prepare_k8s_client()
+            report.result = getattr(boot, action)()
+            report.status = 'ok'
+        except Exception as ex:
+            report.status = 'failed'
+            report.error = ex
+            log.error(f"集群[%s] %s失败", boot.context, action, exc_info=ex)
+            if self.fail_fast:
+                self.abort.set()
+        finally:
+            report.seconds = time.time() - start
+            self.boot.metrics.record_cluster(boot.context, report.status == 'ok', report.seconds, boot.metrics)
+
+    def report(self, action):
+        '''
+        输出每个集群的汇总
+        '''
+        for context in self.contexts:
+            log.info(str(self.reports[context]))
+        statuses = [report.status for report in self.reports.values()]
+        log.info(f"多集群{action}汇总: 成功%s个, 失败%s个, 跳过%s个", statuses.count('ok'), statuses.count('failed'), statuses.count('skipped'))
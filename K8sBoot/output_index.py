@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import json
+import os
+from pyutilb.log import log
+from K8sBoot.manifest import get_file_sign
+from K8sBoot.yaml_io import load_yaml_doc, scan_yaml_spans, write_file_if_changed
+
+# 资源类型(kind)对应k8s api的资源类型
+kind2type = {
+    'Namespace': 'ns',
+    'PersistentVolume': 'pv',
+    'ConfigMap': 'config',
+    'Secret': 'secret',
+    'PersistentVolumeClaim': 'pvc',
+    'Pod': 'pod',
+    'ReplicationController': 'rc',
+    'ReplicaSet': 'rs',
+    'DaemonSet': 'ds',
+    'StatefulSet': 'sts',
+    'Deployment': 'deploy',
+    'Job': 'job',
+    'CronJob': 'cronjob',
+    'Service': 'svc',
+    'Ingress': 'ingress',
+    'HorizontalPodAutoscaler': 'hpa',
+    'PodDisruptionBudget': 'pdb',
+}
+
+# 获得资源的api类型，未知kind则返回kind本身
+def get_yaml_type(yml):
+    kind = yml.get('kind')
+    return kind2type.get(kind, kind)
+
+# 构建单个资源的索引项
+def build_entry(yml, offset, length):
+    meta = yml.get('metadata') or {}
+    labels = meta.get('labels') or {}
+    return {
+        'kind': yml.get('kind'),
+        'apiVersion': yml.get('apiVersion'),
+        'type': get_yaml_type(yml),
+        'name': meta.get('name') or meta.get('generateName'),
+        'namespace': meta.get('namespace'),
+        'app': labels.get('app'),
+        'offset': offset,
+        'length': length,
+    }
+
+'''
+输出目录的资源索引，保存在输出目录下的 .k8sboot-index.json
+    记录每个资源文件的签名(内容的md5)，以及文件中每个资源的kind/apiVersion/名字/命名空间/app/字节偏移与长度
+    apply/create/delete 时按索引过滤资源并直接定位读取，不用解析文件名，也不用加载无关的资源
+'''
+class OutputIndex(object):
+
+    file_name = '.k8sboot-index.json'
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, self.file_name)
+        self.last_files = self.load() # 上次的索引
+        self.files = {} # 本次生成的文件的索引
+
+    # 加载上次的索引
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r', encoding="utf-8") as f:
+                return json.load(f).get('files', {})
+        except Exception as ex:
+            log.warning(f"资源索引[%s]已损坏, 将重建: %s", self.path, ex)
+            return {}
+
+    def record(self, file, ymls, spans):
+        '''
+        记录本次生成的资源文件
+        :param file 文件名
+        :param ymls 文件中的资源
+        :param spans 每个资源在文件中的位置[(字节偏移, 字节长度)]
+        '''
+        self.files[file] = {
+            'objects': [build_entry(yml, offset, length) for yml, (offset, length) in zip(ymls, spans)],
+        }
+
+    def refresh(self):
+        '''
+        同步输出目录中的资源文件: 沿用签名未变的文件的上次索引，重建没有索引或有变化的文件的索引，去掉已删除的文件
+        :return 是否有变化
+        '''
+        files = {}
+        names = os.listdir(self.output_dir) if os.path.isdir(self.output_dir) else [] # 没有渲染出资源(如只修正节点标签)则没有输出目录
+        for file in sorted(names):
+            if not fnmatch.fnmatch(file, '*.yml'):
+                continue
+            sign = get_file_sign(os.path.join(self.output_dir, file))
+            rec = self.files.get(file)
+            if rec is None:
+                rec = self.last_files.get(file)
+                if rec is not None and rec.get('sign') != sign:
+                    rec = None
+            if rec is None:
+                rec = self.scan(file)
+            rec['sign'] = sign
+            files[file] = rec
+        changed = files != self.last_files
+        self.files = files
+        return changed
+
+    # 扫描资源文件，构建其索引
+    def scan(self, file):
+        log.debug(f"扫描资源文件: %s", file)
+        objects = []
+        with open(os.path.join(self.output_dir, file), 'rb') as f:
+            for offset, length in scan_yaml_spans(f.read()):
+                yml = load_yaml_doc(f, offset, length)
+                if yml is not None: # 忽略空文档
+                    objects.append(build_entry(yml, offset, length))
+        return {'objects': objects}
+
+    # 保存索引: 先同步输出目录，内容有变化才写
+    def save(self):
+        if not os.path.isdir(self.output_dir):
+            return
+        if self.refresh():
+            txt = json.dumps({'files': self.files}, sort_keys=True, ensure_ascii=False, indent=1)
+            write_file_if_changed(self.path, txt)
+
+    def query(self, apps = None, kinds = None):
+        '''
+        按app与kind过滤资源
+        :param apps app名列表，为空则不过滤
+        :param kinds kind或api资源类型列表，为空则不过滤
+        :return 索引项列表，每项多了file属性
+        '''
+        ret = []
+        for file, rec in sorted(self.files.items()):
+            for entry in rec['objects']:
+                if apps and entry['app'] not in apps:
+                    continue
+                if kinds and entry['kind'] not in kinds and entry['type'] not in kinds:
+                    continue
+                ret.append(dict(entry, file=file))
+        return ret
+
+    def load_objects(self, entries):
+        '''
+        按索引项读取资源，同一文件只打开一次
+        :param entries 索引项列表
+        :return 生成器，元素是(资源类型, 资源yaml)
+        '''
+        f = None
+        file = None
+        try:
+            for entry in entries:
+                if entry['file'] != file:
+                    if f is not None:
+                        f.close()
+                    file = entry['file']
+                    f = open(os.path.join(self.output_dir, file), 'rb')
+                yield entry['type'], load_yaml_doc(f, entry['offset'], entry['length'])
+        finally:
+            if f is not None:
+                f.close()
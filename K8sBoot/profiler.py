@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import cProfile
+import sys
+import time
+import tracemalloc
+from pyutilb.util import custom_funs
+
+# 要统计的boot模块中直接调用的函数: 变量替换与yaml读写
+module_funs = ('replace_var', 'write_yaml_file', 'load_yaml_file')
+
+# 也要包装变量替换的pyutilb模块: @replace_var_on_params装饰器(及replace_var的递归)与YamlBoot通过各自模块的全局变量调用replace_var
+replace_var_modules = ('pyutilb.util', 'pyutilb.yaml_boot')
+
+'''
+单个函数的统计
+'''
+class FuncStat(object):
+
+    def __init__(self, kind, name):
+        self.kind = kind # 类型: action/fun/method
+        self.name = name
+        self.count = 0 # 调用次数
+        self.cum = 0.0 # 累计耗时(含子调用)
+        self.self = 0.0 # 自身耗时(不含被统计的子调用)
+        self.depth = 0 # 当前的调用深度，递归调用(如replace_var)只有最外层计入累计耗时
+
+'''
+渲染的性能剖析器，用于 --profile
+    1 包装Boot的所有动作、所有自定义函数(如ref_config/ref_secret)、build_*等内部方法、以及变量替换(含@replace_var_on_params)与yaml读写，统计调用次数、累计耗时与自身耗时
+    2 可选用tracemalloc统计每个app渲染期间的内存分配峰值
+    3 同时用cProfile做全量剖析，可导出pstats文件，用 python -m pstats 或 snakeviz 查看
+'''
+class Profiler(object):
+
+    def __init__(self, trace_malloc = False):
+        '''
+        :param trace_malloc 是否统计每个app的内存分配峰值
+        '''
+        self.trace_malloc = trace_malloc
+        self.stats = {} # 函数统计: (类型, 名字) -> FuncStat
+        self.app_peaks = {} # 每个app的内存分配峰值(字节)
+        self._stack = [] # 调用栈，每层记录被统计的子调用的耗时
+        self._restores = [] # 停止时要恢复的被替换的函数: (对象, 属性名, 原值)
+        self.cprofile = cProfile.Profile()
+
+    def wrap(self, kind, name, func):
+        '''
+        包装函数，统计其耗时
+        :param kind 类型: action/fun/method
+        :param name 名字
+        :param func 函数
+        '''
+        stat = self.stats.setdefault((kind, name), FuncStat(kind, name))
+        def wrapper(*args, **kwargs):
+            self._stack.append(0.0)
+            stat.depth += 1
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                cost = time.perf_counter() - start
+                child = self._stack.pop()
+                if self._stack:
+                    self._stack[-1] += cost
+                stat.depth -= 1
+                stat.count += 1
+                if stat.depth == 0:
+                    stat.cum += cost
+                stat.self += cost - child
+        return wrapper
+
+    def patch(self, obj, attr, kind, name = None):
+        '''
+        替换对象的属性为包装后的函数，停止时恢复
+        :param obj 对象/dict/模块
+        :param attr 属性名或key
+        :param kind 类型
+        :param name 统计用的名字，默认为属性名
+        '''
+        if isinstance(obj, dict):
+            old = obj[attr]
+            obj[attr] = self.wrap(kind, name or attr, old)
+        else:
+            old = obj.__dict__.get(attr) # 实例属性或模块变量，不存在则为None，恢复时删掉
+            setattr(obj, attr, self.wrap(kind, name or attr, getattr(obj, attr)))
+        self._restores.append((obj, attr, old))
+
+    def attach(self, boot):
+        '''
+        包装boot的动作、自定义函数与内部方法
+        :param boot Boot实例
+        '''
+        for name in list(boot.actions.keys()):
+            self.patch(boot.actions, name, 'action')
+        if self.trace_malloc: # 统计每个app的内存分配峰值
+            boot.actions['app'] = self.trace_app(boot.actions['app'])
+        for name in list(custom_funs.keys()):
+            self.patch(custom_funs, name, 'fun')
+        for name in dir(type(boot)):
+            if name.startswith('build_') or name in ('save_yaml', 'stamp_hash'):
+                self.patch(boot, name, 'method')
+        module = sys.modules[type(boot).__module__]
+        for name in module_funs:
+            self.patch(module, name, 'fun')
+        for name in replace_var_modules:
+            self.patch(sys.modules[name], 'replace_var', 'fun')
+
+    # 包装app动作，统计该app渲染期间的内存分配峰值
+    def trace_app(self, func):
+        def wrapper(steps, name = None, *args):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            try:
+                return func(steps, name, *args)
+            finally:
+                self.app_peaks[name] = tracemalloc.get_traced_memory()[1] - base
+        return wrapper
+
+    def start(self):
+        if self.trace_malloc:
+            tracemalloc.start()
+        self.cprofile.enable()
+
+    # 停止剖析，并恢复被包装的函数
+    def stop(self):
+        self.cprofile.disable()
+        if self.trace_malloc:
+            tracemalloc.stop()
+        for obj, attr, old in reversed(self._restores):
+            if isinstance(obj, dict):
+                obj[attr] = old
+            elif old is None:
+                delattr(obj, attr)
+            else:
+                setattr(obj, attr, old)
+        self._restores = []
+
+    def dump_stats(self, path):
+        '''
+        导出cProfile的pstats文件
+        :param path 文件路径
+        '''
+        self.cprofile.dump_stats(path)
+
+    def report(self, file = None, top = 30):
+        '''
+        输出按自身耗时排序的报告，默认输出到stderr
+        :param file 输出的文件对象
+        :param top 最多输出的行数
+        '''
+        file = file or sys.stderr
+        stats = sorted((stat for stat in self.stats.values() if stat.count), key=lambda stat: -stat.self)
+        print(f"{'kind':<8}{'name':<36}{'count':>8}{'cum(ms)':>10}{'self(ms)':>10}{'avg(ms)':>10}", file=file)
+        for stat in stats[:top]:
+            print(f"{stat.kind:<8}{stat.name:<36}{stat.count:>8}{stat.cum * 1000:>10.1f}{stat.self * 1000:>10.1f}{stat.cum * 1000 / stat.count:>10.3f}", file=file)
+        if self.app_peaks:
+            print(f"\n{'app':<44}{'peak alloc(KB)':>16}", file=file)
+            for app, peak in sorted(self.app_peaks.items(), key=lambda item: -item[1])[:top]:
+                print(f"{str(app):<44}{peak / 1024:>16.1f}", file=file)
@@ -0,0 +1,40 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+'''
+令牌桶限流器，与client-go的 --kube-api-qps/--kube-api-burst 一样
+    令牌以qps的速率补充，桶的容量为burst，即允许短时突发burst个请求
+    多线程共用，每次请求取一个令牌，没有令牌则预约并等待，因此等待的线程按到达顺序依次放行
+'''
+class TokenBucket(object):
+
+    def __init__(self, qps, burst):
+        '''
+        :param qps 每秒的请求数，<=0表示不限流
+        :param burst 允许突发的请求数
+        '''
+        self.qps = float(qps)
+        self.burst = max(1, int(burst))
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        获取一个令牌，没有则等待
+        :return 等待的秒数
+        '''
+        if self.qps <= 0:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.qps)
+            self.last = now
+            self.tokens -= 1 # 没有令牌时预约未来的令牌，令牌数为负
+            wait = -self.tokens / self.qps if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
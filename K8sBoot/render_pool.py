@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import os
+import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pyutilb.util import get_vars, vars_stacks, custom_funs
+from pyutilb.module_loader import load_module_funs
+from pyutilb.log import log, AsyncLogger
+from K8sBoot.manifest import Manifest, build_fingerprint
+from K8sBoot.metrics import RunMetrics
+from K8sBoot.output_index import OutputIndex
+from K8sBoot.yaml_io import replace_if_changed
+
+# 子进程的临时输出目录
+jobs_dir_name = '.jobs'
+
+def expand_step_files(step_files):
+    '''
+    展开步骤文件: 目录展开为按文件名排序的*.yml文件，模式(含*)展开为匹配的文件
+    :param step_files 步骤文件或目录
+    :return 步骤文件列表
+    '''
+    ret = []
+    for path in step_files:
+        pattern = '*.yml'
+        if '*' in path:
+            path, pattern = path.rsplit(os.sep, 1)
+        if not os.path.exists(path):
+            raise Exception(f'Step config file or directory not exist: {path}')
+        if not os.path.isdir(path):
+            ret.append(path)
+            continue
+        for file in sorted(os.listdir(path)):
+            file = os.path.join(path, file)
+            if fnmatch.fnmatch(os.path.basename(file), pattern) and os.path.isfile(file):
+                ret.append(file)
+    return ret
+
+# ---------------- 子进程 ----------------
+'''
+记录读写的变量字典，用作步骤文件渲染时的变量(变量栈顶)
+    只记录在本文件写之前就读的变量，即依赖前面的步骤文件(或-d/-D)的变量
+'''
+class VarsRecorder(dict):
+
+    def __init__(self, vars, reads = None, writes = None):
+        super().__init__(vars)
+        self.reads = set() if reads is None else reads # 读取的外部变量名
+        self.writes = set() if writes is None else writes # 本文件写过的变量名
+
+    def record(self, key):
+        if key not in self.writes:
+            self.reads.add(key)
+
+    def __getitem__(self, key):
+        self.record(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self.record(key)
+        return super().__contains__(key)
+
+    def get(self, key, default = None):
+        self.record(key)
+        return super().get(key, default)
+
+    def __setitem__(self, key, value):
+        self.writes.add(key)
+        super().__setitem__(key, value)
+
+    def update(self, *args, **kwargs):
+        vals = dict(*args, **kwargs)
+        self.writes.update(vals)
+        super().update(vals)
+
+    # 复制(如变量栈入栈)后仍记录到同一组变量名
+    def copy(self):
+        return VarsRecorder(self, self.reads, self.writes)
+
+# 不共享的变量: boot是Boot对象，ns由共享状态的命名空间处理
+unshared_vars = ('boot', 'ns')
+
+def export_vars(recorder):
+    '''
+    导出步骤文件写过的变量，作为后面的步骤文件的共享状态
+        要跨进程传递，不能pickle的变量(如函数)不共享
+    '''
+    ret = {}
+    for key in recorder.writes:
+        if key in unshared_vars or not dict.__contains__(recorder, key):
+            continue
+        val = dict.__getitem__(recorder, key)
+        try:
+            pickle.dumps(val)
+        except Exception as ex:
+            log.debug(f"变量[%s]不能跨进程共享: %s", key, ex)
+            continue
+        ret[key] = val
+    return ret
+
+# 子进程的初始变量，每个步骤文件渲染前都要恢复，以免受同进程中前一个步骤文件的影响
+worker_vars = {}
+
+def init_worker(vars, funs):
+    '''
+    子进程的初始化
+    :param vars 主进程的变量(由-d/-D指定)
+    :param funs 自定义函数的python文件(由-f指定)
+    '''
+    # fork出来的子进程沿用了主进程的日志线程池，但线程并没有被复制，需重建
+    AsyncLogger._executor = None
+    worker_vars.update(vars)
+    if funs:
+        custom_funs.update(load_module_funs(funs))
+
+def render_1file(file, subdir, seed, options):
+    '''
+    子进程中渲染单个步骤文件
+    :param file 步骤文件
+    :param subdir 临时输出目录
+    :param seed 前面的步骤文件渲染出的共享状态: 命名空间+app端口+变量
+    :param options Boot的构建参数
+    :return 渲染结果
+    '''
+    from K8sBoot.boot import Boot # 延迟导入，避免循环依赖
+    if os.path.exists(subdir):
+        shutil.rmtree(subdir)
+    # 变量 = 初始变量 + 前面的步骤文件设置的变量，同串行渲染
+    recorder = VarsRecorder(dict(worker_vars, **seed['vars']))
+    stack = vars_stacks.get()
+    stack.clear()
+    stack.append(recorder)
+    boot = Boot(subdir, **options)
+    boot.import_state(seed)
+    result = {'error': None}
+    cwd = os.getcwd()
+    try:
+        boot.run([file])
+        result['state'] = boot.export_state()
+        result['vars'] = export_vars(recorder)
+        result['files'] = sorted(boot._written_files)
+        result['apps'] = boot.manifest.apps if boot.manifest is not None else {}
+        result['index'] = boot.index.files
+        result['metrics'] = boot.metrics.to_dict()
+    except Exception as ex:
+        result['error'] = f"{type(ex).__name__}: {ex}"
+    finally:
+        os.chdir(cwd) # 步骤文件执行出错时，YamlBoot不会恢复当前目录
+    # 失败时也要返回引用的app与读取的变量，以便拿到更全的共享状态后重跑
+    result['refs'] = sorted(boot._foreign_refs)
+    result['var_reads'] = sorted(recorder.reads - set(unshared_vars))
+    return result
+
+# ---------------- 主进程 ----------------
+class RenderPool(object):
+    '''
+    多进程渲染器: 每个步骤文件在子进程中渲染到临时目录，再按文件顺序合并到输出目录
+        步骤文件之间共享的状态有命名空间、app端口(被ingress引用)与变量(如set_vars设置的)，因此:
+        1 先用空的共享状态并行渲染所有步骤文件
+        2 按文件顺序累积前面文件的共享状态，如果某文件看到的共享状态(命名空间+引用的app+读取的变量)与上次渲染时不同，则重跑
+        3 重复2直到没有要重跑的文件，结果与串行渲染一致
+    '''
+
+    def __init__(self, output_dir, jobs, workers = None, incremental = False, funs = None):
+        '''
+        :param output_dir 输出目录
+        :param jobs 进程数
+        :param workers 应用k8s资源时并发调用api的线程数
+        :param incremental 是否增量渲染
+        :param funs 自定义函数的python文件
+        '''
+        self.output_dir = os.path.abspath(output_dir or 'out')
+        self.jobs = int(jobs)
+        self.incremental = incremental
+        self.funs = funs
+        self.options = {
+            'workers': workers,
+            'incremental': incremental,
+            'manifest_dir': self.output_dir,
+        }
+        self.jobs_dir = os.path.join(self.output_dir, jobs_dir_name)
+        self.file_stat = {'written': 0, 'unchanged': 0}
+        self.metrics = RunMetrics() # 合并子进程的渲染指标
+        self.app2deps = {} # 合并子进程渲染的app依赖，用于应用到集群时按依赖分层
+        self.node2labels = {} # 合并子进程记录的节点标签，用于应用到集群时修正节点标签
+
+    def run(self, step_files):
+        '''
+        并行渲染
+        :param step_files 步骤文件或目录
+        '''
+        files = expand_step_files(step_files)
+        vars = {k: v for k, v in get_vars().items() if k != 'boot'}
+        try:
+            with ProcessPoolExecutor(self.jobs, initializer=init_worker, initargs=(vars, self.funs)) as pool:
+                results = self.render_rounds(pool, files)
+            self.merge(results)
+        finally:
+            shutil.rmtree(self.jobs_dir, ignore_errors=True)
+        log.info(f"资源文件已生成到目录%s: 写入%s个, 未变更%s个", self.output_dir, self.file_stat['written'], self.file_stat['unchanged'])
+
+    def render_rounds(self, pool, files):
+        '''
+        多轮渲染，直到每个文件看到的共享状态都稳定
+        :param pool 进程池
+        :param files 步骤文件列表
+        :return 每个文件的渲染结果
+        '''
+        n = len(files)
+        seeds = [self.build_seed([])] * n
+        signs = [None] * n # 每个文件上次渲染时看到的共享状态签名
+        results = [None] * n
+        todo = list(range(n))
+        rounds = 0
+        while todo:
+            rounds += 1
+            log.info(f"并行渲染第%s轮: %s个步骤文件", rounds, len(todo))
+            futures = {i: pool.submit(render_1file, files[i], os.path.join(self.jobs_dir, str(i)), seeds[i], self.options) for i in todo}
+            for i, future in futures.items():
+                results[i] = future.result()
+                signs[i] = self.build_seed_sign(seeds[i], results[i])
+            # 按文件顺序累积共享状态，找出看到的共享状态有变化的文件
+            todo = []
+            for i in range(n):
+                seeds[i] = self.build_seed(results[:i])
+                if self.build_seed_sign(seeds[i], results[i]) != signs[i]:
+                    todo.append(i)
+                elif results[i]['error'] is not None: # 共享状态已稳定的失败文件，与串行一样终止
+                    raise Exception(f"渲染步骤文件{files[i]}失败: {results[i]['error']}")
+        return results
+
+    # 累积前面文件的共享状态，失败的文件没有贡献
+    def build_seed(self, results):
+        seed = {'ns': '', 'app2ports': {}, 'app2port2service': {}, 'vars': {}}
+        for result in results:
+            if result['error'] is not None:
+                continue
+            state = result['state']
+            if state['ns']:
+                seed['ns'] = state['ns']
+            seed['app2ports'].update(state['app2ports'])
+            seed['app2port2service'].update(state['app2port2service'])
+            seed['vars'].update(result['vars'])
+        return seed
+
+    # 文件看到的共享状态签名: 命名空间+引用的app的端口+读取的变量
+    def build_seed_sign(self, seed, result):
+        refs = result['refs']
+        return build_fingerprint([
+            seed['ns'],
+            [seed['app2ports'].get(app) for app in refs],
+            [seed['app2port2service'].get(app) for app in refs],
+            [(name, name in seed['vars'], seed['vars'].get(name)) for name in result['var_reads']],
+        ])
+
+    # 按文件顺序合并到输出目录: 同名文件以后面的为准
+    def merge(self, results):
+        srcs = {}
+        for i, result in enumerate(results):
+            for file in result['files']:
+                srcs[file] = os.path.join(self.jobs_dir, str(i), file)
+        os.makedirs(self.output_dir, exist_ok=True)
+        for file, src in sorted(srcs.items()):
+            size = os.path.getsize(src)
+            written = replace_if_changed(src, os.path.join(self.output_dir, file))
+            if written:
+                self.file_stat['written'] += 1
+            else:
+                self.file_stat['unchanged'] += 1
+            self.metrics.record_file(size, written)
+        for result in results:
+            self.metrics.merge(result['metrics'])
+            self.app2deps.update(result['state']['app2deps'])
+            for node, labels in result['state']['node2labels'].items():
+                self.node2labels.setdefault(node, {}).update(labels)
+        # 合并增量渲染的清单
+        if self.incremental:
+            manifest = Manifest(self.output_dir)
+            for result in results:
+                manifest.apps.update(result['apps'])
+            manifest.clean_stale_files(srcs.keys())
+            manifest.save()
+        # 合并资源索引: 资源在文件中的位置不变
+        index = OutputIndex(self.output_dir)
+        for result in results:
+            index.files.update(result['index'])
+        index.save()
@@ -0,0 +1,682 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import heapq
+import json
+from functools import lru_cache
+from pyutilb.log import log
+from K8sBoot.yaml_io import load_yaml_file
+
+'''
+离线的调度与容量模拟: 不连集群，按节点快照(标签/污点/可分配资源)模拟调度渲染出的所有pod副本
+    调度条件与kube-scheduler的过滤插件一致: nodeSelector、节点硬亲和性、污点容忍、资源请求、pod数上限、宿主机端口、pod硬(反)亲和性
+    打分: spread(默认，同kube-scheduler的LeastAllocated，优先剩余资源多的节点) 或 binpack(MostAllocated，优先填满节点)
+    性能: 与pod无关的条件(选择器/亲和性/污点)每个pod模板只算一次; 同一工作负载的副本请求相同，用堆按分数选节点，放不下的节点直接出堆;
+        拓扑分布约束的各拓扑域pod数用计数器增量维护，按拓扑域分堆，不用每个副本都遍历节点与已调度的pod
+'''
+
+# 模拟调度的资源类型
+kind_replicas = {
+    'Pod': None,
+    'ReplicationController': 'replicas',
+    'ReplicaSet': 'replicas',
+    'Deployment': 'replicas',
+    'StatefulSet': 'replicas',
+    'Job': 'parallelism',
+}
+
+# 会阻止调度的污点效果
+blocking_effects = ('NoSchedule', 'NoExecute')
+
+# 不满足拓扑分布约束的原因: 其他拓扑域的pod增加后可能又满足了，因此节点不能出堆
+spread_reason = "didn't match pod topology spread constraints"
+
+@lru_cache(maxsize=None)
+def parse_number(value):
+    '''
+    解析资源量为数值，如 100m -> 0.1, 1Gi -> 1073741824
+    '''
+    from kubernetes.utils import parse_quantity # 延迟导入: 只有模拟时才需要
+    return float(parse_quantity(str(value)))
+
+def parse_resources(resources):
+    return {key: parse_number(val) for key, val in (resources or {}).items()}
+
+def get_pod_requests(spec):
+    '''
+    计算pod的资源请求: 容器请求之和与初始化容器请求的最大值中取大者，没有请求则用限制(同apiserver的默认值)
+    :param spec pod的spec
+    :return {资源名: 数值}
+    '''
+    def container_requests(container):
+        resources = container.get('resources') or {}
+        return parse_resources(dict(resources.get('limits') or {}, **(resources.get('requests') or {})))
+    ret = {}
+    for container in spec.get('containers') or []:
+        for key, val in container_requests(container).items():
+            ret[key] = ret.get(key, 0) + val
+    for container in spec.get('initContainers') or []:
+        for key, val in container_requests(container).items():
+            ret[key] = max(ret.get(key, 0), val)
+    return ret
+
+def get_host_ports(spec):
+    '''
+    获得pod占用的宿主机端口: hostPort，hostNetwork时容器端口即宿主机端口
+    '''
+    ret = set()
+    for container in spec.get('containers') or []:
+        for port in container.get('ports') or []:
+            host_port = port.get('hostPort') or (port.get('containerPort') if spec.get('hostNetwork') else None)
+            if host_port:
+                ret.add((port.get('protocol') or 'TCP', int(host_port)))
+    return ret
+
+def match_expression(labels, expr):
+    '''
+    匹配单个选择表达式，操作符有In/NotIn/Exists/DoesNotExist/Gt/Lt
+    :param labels 标签
+    :param expr {key, operator, values}
+    '''
+    key = expr['key']
+    op = expr['operator'].lower()
+    values = expr.get('values')
+    if values is not None and not isinstance(values, list):
+        values = [values]
+    values = [str(val) for val in values or []]
+    if op == 'in':
+        return key in labels and str(labels[key]) in values
+    if op == 'notin':
+        return key not in labels or str(labels[key]) not in values
+    if op == 'exists':
+        return key in labels
+    if op == 'doesnotexist':
+        return key not in labels
+    if op in ('gt', 'lt'):
+        try:
+            val = float(labels[key])
+            bound = float(values[0])
+        except (KeyError, IndexError, ValueError):
+            return False
+        return val > bound if op == 'gt' else val < bound
+    raise Exception(f'不支持的选择操作符: {expr["operator"]}')
+
+def match_label_selector(labels, selector):
+    '''
+    匹配标签选择器: matchLabels与matchExpressions都要满足
+    '''
+    if not selector:
+        return False
+    for key, val in (selector.get('matchLabels') or {}).items():
+        if str(labels.get(key)) != str(val):
+            return False
+    return all(match_expression(labels, expr) for expr in selector.get('matchExpressions') or [])
+
+def match_node_selector_term(node, term):
+    '''
+    匹配节点选择项: matchExpressions匹配节点标签，matchFields匹配节点名
+    '''
+    if not term:
+        return False
+    for key, val in (term.get('matchLabels') or {}).items(): # 兼容: 也接受matchLabels
+        if str(node.labels.get(key)) != str(val):
+            return False
+    if not all(match_expression(node.labels, expr) for expr in term.get('matchExpressions') or []):
+        return False
+    return all(match_expression({'metadata.name': node.name}, expr) for expr in term.get('matchFields') or [])
+
+def tolerates(tolerations, taint):
+    '''
+    容忍是否匹配污点
+    '''
+    for toleration in tolerations:
+        effect = toleration.get('effect')
+        if effect and effect != taint.get('effect'):
+            continue
+        key = toleration.get('key')
+        if not key: # 空key+Exists容忍所有污点
+            if toleration.get('operator') == 'Exists':
+                return True
+            continue
+        if key != taint.get('key'):
+            continue
+        if toleration.get('operator') == 'Exists' or str(toleration.get('value') or '') == str(taint.get('value') or ''):
+            return True
+    return False
+
+'''
+模拟的节点
+'''
+class SimNode(object):
+
+    def __init__(self, name, labels = None, taints = None, allocatable = None, requested = None, unschedulable = False):
+        '''
+        :param name 节点名
+        :param labels 标签
+        :param taints 污点列表
+        :param allocatable 可分配资源，如 {cpu: 4, memory: 16Gi, pods: 110}
+        :param requested 已被其他pod占用的资源，如 {cpu: 500m, memory: 1Gi, pods: 5}
+        :param unschedulable 是否被cordon，等价于污点 node.kubernetes.io/unschedulable:NoSchedule
+        '''
+        self.name = name
+        self.labels = {key: str(val) for key, val in (labels or {}).items()}
+        self.labels.setdefault('kubernetes.io/hostname', name) # kubelet总会设置，快照中可省
+        self.taints = [taint for taint in taints or [] if taint.get('effect') in blocking_effects]
+        if unschedulable:
+            self.taints.append({'key': 'node.kubernetes.io/unschedulable', 'effect': 'NoSchedule'})
+        self.allocatable = parse_resources(allocatable)
+        self.allocatable.setdefault('pods', 110) # kubelet的默认值
+        self.requested = parse_resources(requested)
+        self.pods = [] # 模拟调度到本节点的pod: (工作负载简称, 资源请求)
+        self.host_ports = set() # 已占用的宿主机端口
+
+    def free(self, key):
+        return self.allocatable.get(key, 0) - self.requested.get(key, 0)
+
+    def add_pod(self, label, requests, host_ports):
+        for key, val in requests.items():
+            self.requested[key] = self.requested.get(key, 0) + val
+        self.requested['pods'] = self.requested.get('pods', 0) + 1
+        self.host_ports |= host_ports
+        self.pods.append((label, requests))
+
+def load_nodes(path):
+    '''
+    读节点快照文件(json/yaml)，支持两种格式:
+        1 kubectl get nodes -o json/yaml 的输出，即NodeList或Node列表
+        2 简化格式: [{name, labels, taints, allocatable, requested, unschedulable}]
+    :param path 文件路径
+    :return SimNode列表
+    '''
+    if path.endswith('.json'):
+        with open(path, 'r', encoding="utf-8") as f:
+            data = json.load(f)
+    else:
+        docs = load_yaml_file(path)
+        data = docs[0] if len(docs) == 1 else docs
+    if isinstance(data, dict):
+        data = data.get('items') if 'items' in data else data.get('nodes', [data])
+    nodes = []
+    for item in data or []:
+        if 'metadata' in item: # Node对象
+            meta = item['metadata']
+            spec = item.get('spec') or {}
+            status = item.get('status') or {}
+            nodes.append(SimNode(meta['name'], meta.get('labels'), spec.get('taints'), status.get('allocatable') or status.get('capacity'), None, spec.get('unschedulable')))
+        else:
+            nodes.append(SimNode(item['name'], item.get('labels'), item.get('taints'), item.get('allocatable'), item.get('requested'), item.get('unschedulable')))
+    if not nodes:
+        raise Exception(f'节点快照文件中没有节点: {path}')
+    return nodes
+
+'''
+pod模板: 同一工作负载的副本共用
+'''
+class PodTemplate(object):
+
+    def __init__(self, yml, namespace):
+        '''
+        :param yml 工作负载资源
+        :param namespace 命名空间
+        '''
+        kind = yml['kind']
+        meta = yml['metadata']
+        spec = yml.get('spec') or {}
+        if kind == 'Pod':
+            self.replicas = 1
+            pod_meta = meta
+        else:
+            self.replicas = spec.get(kind_replicas.get(kind) or 'replicas', 1) if kind != 'DaemonSet' else None
+            template = spec.get('template') or {}
+            pod_meta = template.get('metadata') or {}
+            spec = template.get('spec') or {}
+        self.label = f"{kind} {namespace}/{meta.get('name') or meta.get('generateName')}"
+        self.kind = kind
+        self.namespace = namespace
+        self.labels = pod_meta.get('labels') or {}
+        self.spec = spec
+        self.requests = get_pod_requests(spec)
+        self.host_ports = get_host_ports(spec)
+        affinity = spec.get('affinity') or {}
+        self.affinity_terms = (affinity.get('podAffinity') or {}).get('requiredDuringSchedulingIgnoredDuringExecution') or []
+        self.anti_affinity_terms = (affinity.get('podAntiAffinity') or {}).get('requiredDuringSchedulingIgnoredDuringExecution') or []
+        # 硬的拓扑分布约束，软约束(ScheduleAnyway)只影响打分，不模拟
+        self.spread_terms = [term for term in spec.get('topologySpreadConstraints') or [] if term.get('whenUnsatisfiable', 'DoNotSchedule') == 'DoNotSchedule']
+
+    def static_key(self):
+        '''
+        与pod无关的调度条件的签名，条件相同的模板共用可调度节点的计算结果
+        '''
+        spec = self.spec
+        return json.dumps([spec.get('nodeSelector'), (spec.get('affinity') or {}).get('nodeAffinity'), spec.get('tolerations')], sort_keys=True, default=str)
+
+    def check_static(self, node):
+        '''
+        检查与其他pod无关的静态条件: nodeSelector、节点硬亲和性、污点容忍
+        :return 不满足的原因，满足则为None
+        '''
+        if not self.match_node_affinity(node):
+            return "didn't match Pod's node affinity/selector"
+        taint = self.get_untolerated_taint(node)
+        if taint is not None:
+            return f"had untolerated taint {{{taint.get('key')}: {taint.get('value') or ''}}}"
+        return None
+
+    def match_node_affinity(self, node):
+        '''
+        节点是否匹配nodeSelector与节点硬亲和性
+        '''
+        spec = self.spec
+        for key, val in (spec.get('nodeSelector') or {}).items():
+            if node.labels.get(key) != str(val):
+                return False
+        required = ((spec.get('affinity') or {}).get('nodeAffinity') or {}).get('requiredDuringSchedulingIgnoredDuringExecution')
+        return not required or any(match_node_selector_term(node, term) for term in required.get('nodeSelectorTerms') or [])
+
+    def get_untolerated_taint(self, node):
+        '''
+        获得节点上第一个不被容忍的污点，都容忍则为None
+        '''
+        tolerations = self.spec.get('tolerations') or []
+        for taint in node.taints:
+            if not tolerates(tolerations, taint):
+                return taint
+        return None
+
+'''
+拓扑分布约束的计数器: 命名空间、拓扑key与标签选择器相同的约束共用，记录各拓扑域中匹配选择器的已调度pod数
+    调度pod时(Simulator.place())增量更新，不用每个副本都重新匹配已调度的pod
+'''
+class SpreadCounter(object):
+
+    def __init__(self, namespace, key, selector):
+        '''
+        :param namespace 命名空间
+        :param key 拓扑key
+        :param selector 标签选择器
+        '''
+        self.namespace = namespace
+        self.key = key
+        self.selector = selector
+        self.counts = {} # 拓扑值 -> 匹配的pod数
+        self.matches = {} # pod模板 -> 是否匹配选择器
+
+    def match(self, template):
+        ret = self.matches.get(template)
+        if ret is None:
+            ret = self.matches[template] = template.namespace == self.namespace and match_label_selector(template.labels, self.selector)
+        return ret
+
+    def add(self, template, node):
+        '''
+        调度pod后计数: 只计匹配选择器的pod
+        '''
+        value = node.labels.get(self.key)
+        if value is not None and self.match(template):
+            self.counts[value] = self.counts.get(value, 0) + 1
+
+'''
+工作负载调度中的单个拓扑分布约束: 只看约束的拓扑域，用直方图(pod数 -> 拓扑域数)增量维护拓扑域的最少pod数
+'''
+class SpreadState(object):
+
+    def __init__(self, term, counter, values):
+        '''
+        :param term 拓扑分布约束
+        :param counter SpreadCounter
+        :param values 约束的拓扑域的值，参考 Simulator.get_spread_states()
+        '''
+        self.key = counter.key
+        self.max_skew = int(term.get('maxSkew', 1))
+        self.counter = counter
+        self.values = values
+        self.histogram = {}
+        for value in values:
+            count = counter.counts.get(value, 0)
+            self.histogram[count] = self.histogram.get(count, 0) + 1
+        self.min = min(self.histogram, default=0)
+
+    def allows(self, value):
+        '''
+        放到该拓扑域后，其pod数 - 最少的拓扑域的pod数 不能超过maxSkew
+        '''
+        return self.counter.counts.get(value, 0) + 1 - self.min <= self.max_skew
+
+    def add(self, template, node):
+        '''
+        调度pod(计数器已计数)后更新最少pod数
+        '''
+        value = node.labels.get(self.key)
+        if value not in self.values or not self.counter.match(template):
+            return
+        count = self.counter.counts[value]
+        self.histogram[count - 1] -= 1
+        self.histogram[count] = self.histogram.get(count, 0) + 1
+        if count - 1 == self.min and not self.histogram[count - 1]:
+            self.min = count
+
+'''
+调度模拟器
+'''
+class Simulator(object):
+
+    def __init__(self, nodes, strategy = 'spread'):
+        '''
+        :param nodes SimNode列表
+        :param strategy 打分策略: spread 优先剩余资源多的节点(同kube-scheduler默认); binpack 优先填满节点
+        '''
+        if strategy not in ('spread', 'binpack'):
+            raise Exception(f'不支持的调度策略: {strategy}')
+        self.nodes = nodes
+        self.strategy = strategy
+        self.static_cache = {} # 静态条件签名 -> 每个节点的不满足原因(满足为None)
+        self.domain_cache = {} # (静态条件签名, 拓扑key, 是否考虑节点亲和性, 是否考虑污点) -> 拓扑分布约束的拓扑域的值
+        self.domain_pods = {} # (拓扑key, 拓扑值) -> 已调度的pod: [(命名空间, 标签)]
+        self.domain_antis = {} # 拓扑key -> 拓扑值 -> 已调度pod的反亲和项: [(命名空间, 标签选择器)]
+        self.spread_counters = {} # (命名空间, 拓扑key, 标签选择器的签名) -> SpreadCounter
+        self.template_counters = {} # pod模板 -> [已检查的计数器数, 匹配的计数器]
+        self.template_pods = {} # pod模板 -> 节点 -> 调度到该节点的pod数
+        self.results = [] # 每个工作负载的调度结果: (模板, 副本数, 无法调度的副本数, 原因)
+        self.scheduled = 0
+        self.unscheduled = 0
+
+    def run(self, templates):
+        '''
+        模拟调度: 先调度DaemonSet(每个节点一个)，再按顺序调度其他工作负载的副本
+        :param templates PodTemplate列表
+        :return 无法调度的pod数
+        '''
+        for template in sorted(templates, key=lambda template: template.kind != 'DaemonSet'):
+            if template.kind == 'DaemonSet':
+                self.schedule_daemon(template)
+            elif template.replicas:
+                self.schedule_replicas(template)
+        return self.unscheduled
+
+    def get_static_reasons(self, template):
+        key = template.static_key()
+        reasons = self.static_cache.get(key)
+        if reasons is None:
+            reasons = self.static_cache[key] = [template.check_static(node) for node in self.nodes]
+        return reasons
+
+    def check_dynamic(self, template, node, spreads = None):
+        '''
+        检查与已调度的pod相关的条件: pod数上限、资源、宿主机端口、pod(反)亲和性、拓扑分布约束
+        :param spreads 拓扑分布约束的SpreadState列表，参考 get_spread_states()
+        :return 不满足的原因，满足则为None
+        '''
+        if node.free('pods') < 1:
+            return 'Too many pods'
+        for key, val in template.requests.items():
+            if val > node.free(key):
+                return f'Insufficient {key}'
+        if template.host_ports & node.host_ports:
+            return "didn't have free ports for the requested pod ports"
+        for term in template.anti_affinity_terms:
+            value = node.labels.get(term.get('topologyKey'))
+            if value is not None and self.has_pod_in_domain(term, template, value):
+                return "didn't match pod anti-affinity rules"
+        # 已调度pod的反亲和项也不能匹配当前pod
+        for key, value2antis in self.domain_antis.items():
+            antis = value2antis.get(node.labels.get(key)) or []
+            if any(ns == template.namespace and match_label_selector(template.labels, selector) for ns, selector in antis):
+                return "didn't match existing pods anti-affinity rules"
+        for term in template.affinity_terms:
+            value = node.labels.get(term.get('topologyKey'))
+            if value is None:
+                return "didn't match pod affinity rules"
+            if not self.has_pod_in_domain(term, template, value):
+                # 第一个pod: 没有任何匹配的pod，且自己匹配自己的选择器，则可以调度
+                if self.has_pod_anywhere(term, template) or not match_label_selector(template.labels, term.get('labelSelector')):
+                    return "didn't match pod affinity rules"
+        for state in spreads or []:
+            value = node.labels.get(state.key)
+            if value is None:
+                return f"{spread_reason} (missing required label)"
+            if not state.allows(value):
+                return spread_reason
+        return None
+
+    def get_spread_states(self, template):
+        '''
+        获得拓扑分布约束的状态，其拓扑域同kube-scheduler:
+            nodeAffinityPolicy 默认Honor，只算匹配nodeSelector与节点硬亲和性的节点，Ignore则算所有节点
+            nodeTaintsPolicy 默认Ignore，有不被容忍的污点的节点也算，Honor则不算
+        :return 每个约束一个SpreadState
+        '''
+        ret = []
+        for term in template.spread_terms:
+            honor_affinity = term.get('nodeAffinityPolicy', 'Honor') == 'Honor'
+            honor_taints = term.get('nodeTaintsPolicy', 'Ignore') == 'Honor'
+            key = term.get('topologyKey')
+            cache_key = (template.static_key(), key, honor_affinity, honor_taints)
+            values = self.domain_cache.get(cache_key)
+            if values is None:
+                values = self.domain_cache[cache_key] = {node.labels.get(key) for node in self.nodes
+                          if (not honor_affinity or template.match_node_affinity(node)) and (not honor_taints or template.get_untolerated_taint(node) is None)}
+                values.discard(None)
+            ret.append(SpreadState(term, self.get_spread_counter(template, term), values))
+        return ret
+
+    def get_spread_counter(self, template, term):
+        '''
+        获得拓扑分布约束的计数器，首次使用时统计已调度的pod，之后由 place() 增量更新
+        '''
+        selector = term.get('labelSelector')
+        sign = (template.namespace, term.get('topologyKey'), json.dumps(selector, sort_keys=True, default=str))
+        counter = self.spread_counters.get(sign)
+        if counter is None:
+            counter = self.spread_counters[sign] = SpreadCounter(template.namespace, term.get('topologyKey'), selector)
+            for placed, node2count in self.template_pods.items():
+                if counter.match(placed):
+                    for node, count in node2count.items():
+                        value = node.labels.get(counter.key)
+                        if value is not None:
+                            counter.counts[value] = counter.counts.get(value, 0) + count
+        return counter
+
+    def has_pod_in_domain(self, term, template, value):
+        namespaces = term.get('namespaces') or [template.namespace]
+        return any(ns in namespaces and match_label_selector(labels, term.get('labelSelector')) for ns, labels in self.domain_pods.get((term.get('topologyKey'), value), []))
+
+    def has_pod_anywhere(self, term, template):
+        key = term.get('topologyKey')
+        return any(self.has_pod_in_domain(term, template, value) for domain, value in self.domain_pods if domain == key)
+
+    def score(self, template, node):
+        '''
+        节点打分，越小越优先(用于最小堆): 按cpu与内存调度后的剩余比例
+        '''
+        ratios = []
+        for key in ('cpu', 'memory'):
+            alloc = node.allocatable.get(key)
+            if alloc:
+                ratios.append((node.free(key) - template.requests.get(key, 0)) / alloc)
+        free_ratio = sum(ratios) / len(ratios) if ratios else 0
+        return -free_ratio if self.strategy == 'spread' else free_ratio
+
+    def place(self, template, node, spreads = ()):
+        '''
+        调度pod到节点，并更新拓扑域的pod、反亲和项与拓扑分布约束的计数
+        :param spreads 当前工作负载的拓扑分布约束的SpreadState列表
+        '''
+        node.add_pod(template.label, template.requests, template.host_ports)
+        node2count = self.template_pods.setdefault(template, {})
+        node2count[node] = node2count.get(node, 0) + 1
+        for key, value in node.labels.items():
+            self.domain_pods.setdefault((key, value), []).append((template.namespace, template.labels))
+        for term in template.anti_affinity_terms:
+            value = node.labels.get(term.get('topologyKey'))
+            if value is not None:
+                self.domain_antis.setdefault(term.get('topologyKey'), {}).setdefault(value, []).append((template.namespace, term.get('labelSelector')))
+        for counter in self.get_matched_counters(template):
+            counter.add(template, node)
+        for state in spreads:
+            state.add(template, node)
+        self.scheduled += 1
+
+    def get_matched_counters(self, template):
+        '''
+        获得匹配pod模板的拓扑分布约束计数器，只检查新建的计数器
+        '''
+        entry = self.template_counters.setdefault(template, [0, []])
+        if entry[0] < len(self.spread_counters):
+            counters = list(self.spread_counters.values())
+            entry[1].extend(counter for counter in counters[entry[0]:] if counter.match(template))
+            entry[0] = len(counters)
+        return entry[1]
+
+    def schedule_replicas(self, template):
+        '''
+        调度工作负载的副本: 有pod硬亲和性的(可调度节点会随着调度而增加)每个副本都遍历所有节点，其他的用堆选节点
+        '''
+        reasons = self.get_static_reasons(template)
+        candidates = [i for i, reason in enumerate(reasons) if reason is None]
+        spreads = self.get_spread_states(template)
+        if template.affinity_terms:
+            failed = self.scan_replicas(template, candidates, spreads)
+        else:
+            failed = self.heap_replicas(template, candidates, spreads)
+        self.unscheduled += failed
+        self.results.append((template, template.replicas, failed, self.explain(template) if failed else None))
+
+    def scan_replicas(self, template, candidates, spreads):
+        '''
+        每个副本都遍历所有可调度节点，取分数最优的
+        :return 无法调度的副本数
+        '''
+        for n in range(template.replicas):
+            fits = [i for i in candidates if self.check_dynamic(template, self.nodes[i], spreads) is None]
+            best = min(fits, key=lambda i: self.score(template, self.nodes[i]), default=None)
+            if best is None:
+                return template.replicas - n
+            self.place(template, self.nodes[best], spreads)
+        return 0
+
+    def heap_replicas(self, template, candidates, spreads):
+        '''
+        用堆选节点: 可调度节点按分数入堆，每次取最优节点，放下后重新打分入堆
+            副本请求相同且节点剩余只减不增，因此因资源/端口/反亲和性放不下的节点对后续副本也放不下，直接出堆
+            有拓扑分布约束的，按拓扑域最少的约束给节点分组，每个拓扑域一个节点堆，各拓扑域再按其最优节点的分数入拓扑域的堆;
+            超过maxSkew的拓扑域与因其他约束放不下的节点只是暂时放不下，放下一个副本后再入堆
+        :return 无法调度的副本数
+        '''
+        group = min(spreads, key=lambda state: len(state.values), default=None)
+        heaps = {} # 拓扑值(无约束则为None) -> 节点堆: [(分数, 节点序号)]
+        for i in candidates:
+            node = self.nodes[i]
+            value = node.labels.get(group.key) if group else None
+            if group and value is None: # 缺少拓扑key的节点不满足约束
+                continue
+            heaps.setdefault(value, []).append((self.score(template, node), i))
+        for heap in heaps.values():
+            heapq.heapify(heap)
+        domains = [] # 拓扑域的堆: [(最优节点的分数, 最优节点的序号, 拓扑值)]，同分数按节点序号，与遍历所有节点的结果一致
+        tops = {} # 在拓扑域的堆中的拓扑值 -> 最优节点，与堆中的不一致则是过期的
+        def push_domain(value):
+            heap = heaps[value]
+            if heap:
+                tops[value] = heap[0]
+                heapq.heappush(domains, heap[0] + (value,))
+        for value in heaps:
+            push_domain(value)
+        for n in range(template.replicas):
+            best = None
+            popped = [] # 本次出堆的拓扑域
+            deferred = [] # 因拓扑分布约束暂时放不下的节点
+            while domains:
+                score, i, value = heapq.heappop(domains)
+                if tops.get(value) != (score, i): # 过期
+                    continue
+                del tops[value]
+                popped.append(value)
+                if group and not group.allows(value):
+                    continue
+                score, i = heapq.heappop(heaps[value])
+                reason = self.check_dynamic(template, self.nodes[i], spreads)
+                if reason is None:
+                    best = i
+                    break
+                if reason == spread_reason:
+                    deferred.append((value, score, i))
+                push_domain(value) # 拓扑域的下一个节点
+            if best is None:
+                return template.replicas - n
+            node = self.nodes[best]
+            self.place(template, node, spreads)
+            heapq.heappush(heaps[popped[-1]], (self.score(template, node), best))
+            for value, score, i in deferred:
+                heapq.heappush(heaps[value], (score, i))
+            for value in popped:
+                push_domain(value)
+        return 0
+
+    def schedule_daemon(self, template):
+        '''
+        调度DaemonSet: 每个满足静态条件的节点一个pod
+        '''
+        reasons = self.get_static_reasons(template)
+        total = failed = 0
+        fail_reasons = {}
+        for node, reason in zip(self.nodes, reasons):
+            if reason is not None:
+                continue
+            total += 1
+            reason = self.check_dynamic(template, node)
+            if reason is None:
+                self.place(template, node)
+            else:
+                failed += 1
+                fail_reasons[reason] = fail_reasons.get(reason, 0) + 1
+        self.unscheduled += failed
+        self.results.append((template, total, failed, self.format_reasons(fail_reasons, total) if failed else None))
+
+    def explain(self, template):
+        '''
+        解释pod为什么无法调度，格式同kube-scheduler的FailedScheduling事件: 0/3 nodes are available: 1 Insufficient cpu, 2 node(s) had untolerated taint
+        '''
+        counts = {}
+        reasons = self.get_static_reasons(template)
+        spreads = self.get_spread_states(template)
+        for node, reason in zip(self.nodes, reasons):
+            reason = reason or self.check_dynamic(template, node, spreads)
+            counts[reason] = counts.get(reason, 0) + 1
+        return self.format_reasons(counts, len(self.nodes))
+
+    def format_reasons(self, counts, total):
+        items = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        parts = [f"{count} {reason}" if reason.startswith('Insufficient') or reason.startswith('Too many') else f"{count} node(s) {reason}" for reason, count in items]
+        return f"0/{total} nodes are available: {', '.join(parts)}"
+
+    def report(self):
+        '''
+        输出模拟结果: 无法调度的工作负载及原因，每个节点的资源使用率与余量
+        '''
+        for template, total, failed, reason in self.results:
+            if failed:
+                print(f"✗ {template.label}: {failed}/{total}个pod无法调度: {reason}")
+        print(f"{'NODE':<24} {'PODS':>9} {'CPU(REQ/ALLOC)':>18} {'CPU%':>6} {'CPU-FREE':>9} {'MEMORY(REQ/ALLOC)':>22} {'MEM%':>6} {'MEM-FREE':>10}")
+        for node in self.nodes:
+            print(f"{node.name:<24} {self.format_usage(node, 'pods', int):>9} {self.format_usage(node, 'cpu', format_cpu):>18} {self.format_percent(node, 'cpu'):>6} {format_cpu(node.free('cpu')):>9} {self.format_usage(node, 'memory', format_bytes):>22} {self.format_percent(node, 'memory'):>6} {format_bytes(node.free('memory')):>10}")
+        totals = {key: (sum(node.requested.get(key, 0) for node in self.nodes), sum(node.allocatable.get(key, 0) for node in self.nodes)) for key in ('cpu', 'memory')}
+        log.info(f"调度模拟汇总: 节点%s个, 已调度pod%s个, 无法调度%s个, cpu使用率%s(余量%s), 内存使用率%s(余量%s)", len(self.nodes), self.scheduled, self.unscheduled,
+                 format_percent(*totals['cpu']), format_cpu(totals['cpu'][1] - totals['cpu'][0]), format_percent(*totals['memory']), format_bytes(totals['memory'][1] - totals['memory'][0]))
+
+    def format_usage(self, node, key, format):
+        return f"{format(node.requested.get(key, 0))}/{format(node.allocatable.get(key, 0))}"
+
+    def format_percent(self, node, key):
+        return format_percent(node.requested.get(key, 0), node.allocatable.get(key, 0))
+
+def format_percent(used, total):
+    return f"{used * 100 / total:.0f}%" if total else '-'
+
+def format_cpu(value):
+    return f"{value:.2f}" if value < 10 else f"{value:.1f}"
+
+def format_bytes(value):
+    for unit, size in (('Gi', 1 << 30), ('Mi', 1 << 20), ('Ki', 1 << 10)):
+        if abs(value) >= size:
+            return f"{value / size:.1f}{unit}"
+    return f"{value:.0f}"
@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+
+'''
+分阶段的耗时统计，用于 --timing 输出启动耗时(如导入模块)与各阶段的耗时
+'''
+class Timing(object):
+
+    def __init__(self, start = None):
+        '''
+        :param start 起始时间(time.perf_counter())，默认为当前时间
+        '''
+        self.start = start or time.perf_counter()
+        self.last = self.start
+        self.phases = [] # 各阶段的耗时: [(阶段名, 耗时秒数)]
+
+    def mark(self, phase, start = None):
+        '''
+        结束一个阶段，记录其耗时
+        :param phase 阶段名
+        :param start 阶段的起始时间，默认为上一阶段的结束时间
+        '''
+        now = time.perf_counter()
+        self.phases.append((phase, now - (start or self.last)))
+        self.last = now
+
+    @property
+    def total(self):
+        return self.last - self.start
+
+    def report(self, file = None):
+        '''
+        输出耗时表格，默认输出到stderr，以免混入资源输出
+        :param file 输出的文件对象
+        '''
+        file = file or sys.stderr
+        width = max([len(phase) for phase, _ in self.phases] + [len('total')])
+        print('耗时统计(毫秒):', file=file)
+        for phase, cost in self.phases:
+            print(f"  {phase:<{width}}  {cost * 1000:10.1f}", file=file)
+        print(f"  {'total':<{width}}  {self.total * 1000:10.1f}", file=file)
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pyutilb.log import log
+
+# 要等待就绪的资源类型
+wait_kinds = ('Deployment', 'StatefulSet', 'DaemonSet', 'Job', 'PersistentVolumeClaim')
+
+def check_ready(kind, obj):
+    '''
+    检查资源是否就绪，规则与 kubectl rollout status / kubectl wait 一致
+    :param kind 资源kind
+    :param obj 集群中的资源dict
+    :return (是否就绪, 失败原因)，未就绪且未失败时原因为None
+    '''
+    meta = obj.get('metadata') or {}
+    spec = obj.get('spec') or {}
+    status = obj.get('status') or {}
+    conditions = {cond.get('type'): cond for cond in status.get('conditions') or []}
+    # pvc: 已绑定
+    if kind == 'PersistentVolumeClaim':
+        phase = status.get('phase')
+        return phase == 'Bound', ('pvc已丢失' if phase == 'Lost' else None)
+    # job: 已完成
+    if kind == 'Job':
+        failed = conditions.get('Failed') or {}
+        if failed.get('status') == 'True':
+            return False, failed.get('message') or failed.get('reason') or 'job失败'
+        return (conditions.get('Complete') or {}).get('status') == 'True', None
+    # 工作负载: 控制器要先观察到最新的spec
+    if (status.get('observedGeneration') or 0) < (meta.get('generation') or 0):
+        return False, None
+    if kind == 'Deployment':
+        progressing = conditions.get('Progressing') or {}
+        if progressing.get('reason') == 'ProgressDeadlineExceeded':
+            return False, progressing.get('message') or 'ProgressDeadlineExceeded'
+        replicas = spec.get('replicas', 1)
+        updated = status.get('updatedReplicas') or 0
+        # 新副本都已创建且可用，旧副本都已终止
+        return updated >= replicas and (status.get('replicas') or 0) <= updated and (status.get('availableReplicas') or 0) >= updated, None
+    strategy = spec.get('updateStrategy') or {}
+    if strategy.get('type') == 'OnDelete': # 不会自动滚动更新
+        return True, None
+    if kind == 'StatefulSet':
+        replicas = spec.get('replicas', 1)
+        if (status.get('readyReplicas') or 0) < replicas:
+            return False, None
+        partition = (strategy.get('rollingUpdate') or {}).get('partition') or 0
+        if partition: # 分区更新: 只有序号>=partition的pod会更新
+            return (status.get('updatedReplicas') or 0) >= replicas - partition, None
+        return status.get('updateRevision') == status.get('currentRevision'), None
+    if kind == 'DaemonSet':
+        desired = status.get('desiredNumberScheduled') or 0
+        return (status.get('updatedNumberScheduled') or 0) >= desired and (status.get('numberAvailable') or 0) >= desired, None
+    return True, None
+
+'''
+基于watch的资源就绪等待器，用于 --wait
+    每个资源类型+命名空间(+app标签)只开一个watch流，代替对每个资源轮询: watch开始时会先推送现有资源(ADDED事件)，之后推送变化
+    所有watch流并发，共用一个全局超时
+'''
+class Waiter(object):
+
+    def __init__(self, k8s, timeout = 300, start = None):
+        '''
+        :param k8s K8sClient
+        :param timeout 全局超时(秒)
+        :param start 计算就绪耗时的起始时间(time.time())，默认为当前时间，一般为开始应用资源的时间
+        '''
+        self.k8s = k8s
+        self.timeout = timeout
+        self.start = start or time.time()
+        self.deadline = None
+        self.ready_seconds = {} # 已就绪的资源: (apiVersion, kind, 命名空间, 资源名) -> 就绪耗时(秒)
+        self.failures = {} # 失败的资源: (apiVersion, kind, 命名空间, 资源名) -> 原因
+        self.pendings = set() # 超时未就绪的资源
+        self.key2app = {} # 资源对应的app
+
+    def wait(self, targets):
+        '''
+        等待资源就绪
+        :param targets 要等待的资源列表，元素是((apiVersion, kind, 命名空间, 资源名), app)
+        '''
+        self.deadline = time.time() + self.timeout
+        groups = {} # (apiVersion, kind, 命名空间) -> 资源名集合
+        for key, app in targets:
+            self.key2app[key] = app
+            groups.setdefault(key[:3], set()).add(key[3])
+        if not groups:
+            return
+        with ThreadPoolExecutor(len(groups)) as pool:
+            futures = [pool.submit(self.watch_group, group, names) for group, names in groups.items()]
+            for future in futures:
+                future.result()
+
+    def watch_group(self, group, names):
+        '''
+        用一个watch流等待同一资源类型+命名空间下的资源就绪，流因超时或出错结束则重新watch，直到全局超时
+        :param group (apiVersion, kind, 命名空间)
+        :param names 资源名集合
+        '''
+        api_version, kind, ns = group
+        pending = set(names)
+        apps = {self.key2app[group + (name,)] for name in names}
+        selector = f"app in ({','.join(sorted(apps))})" if None not in apps else None
+        while pending:
+            remain = self.deadline - time.time()
+            if remain <= 0:
+                break
+            for event in self.k8s.watch(api_version, kind, ns, selector, max(1, int(remain))):
+                if event['type'] == 'ERROR': # 如资源版本过期(410 Gone)，稍后重新watch
+                    log.debug(f"watch %s[%s]出错: %s", kind, ns, event['raw_object'])
+                    time.sleep(1)
+                    break
+                if time.time() > self.deadline: # 服务端一般会按超时结束watch流，这里再兜底
+                    break
+                obj = event['raw_object']
+                name = obj['metadata']['name']
+                if name not in pending or event['type'] == 'DELETED':
+                    continue
+                key = group + (name,)
+                ready, reason = check_ready(kind, obj)
+                if ready:
+                    self.ready_seconds[key] = time.time() - self.start
+                    log.debug(f"%s %s/%s已就绪", kind, ns, name)
+                elif reason:
+                    self.failures[key] = reason
+                if ready or reason:
+                    pending.discard(name)
+                    if not pending:
+                        break
+        self.pendings.update(group + (name,) for name in pending)
+
+    def app_ready_seconds(self):
+        '''
+        每个app的就绪耗时: 其所有资源都就绪的耗时
+        :return {app: 就绪耗时}，有资源未就绪的app不在其中
+        '''
+        bad_apps = {self.key2app[key] for key in list(self.failures) + list(self.pendings)}
+        ret = {}
+        for key, seconds in self.ready_seconds.items():
+            app = self.key2app[key]
+            if app not in bad_apps:
+                ret[app] = max(ret.get(app, 0), seconds)
+        return ret
+
+    def report(self):
+        '''
+        输出每个app的就绪耗时，及失败/超时的资源
+        '''
+        prefix = f"集群[{self.k8s.context}] " if self.k8s.context else '' # 多集群执行时区分集群
+        for app, seconds in sorted(self.app_ready_seconds().items(), key=lambda item: item[1]):
+            log.info(f"{prefix}App[%s]已就绪, 耗时%.1f秒", app, seconds)
+        for (api_version, kind, ns, name), reason in sorted(self.failures.items()):
+            log.error(f"{prefix}%s %s/%s失败: %s", kind, ns, name, reason)
+        for api_version, kind, ns, name in sorted(self.pendings):
+            log.error(f"{prefix}%s %s/%s在%s秒内未就绪", kind, ns, name, self.timeout)
+        log.info(f"{prefix}wait汇总: 就绪%s个, 失败%s个, 超时%s个", len(self.ready_seconds), len(self.failures), len(self.pendings))
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import yaml
+
+# 优先用libyaml实现的C版序列化器，没装libyaml则退化为纯python版
+# 注: 两者对长字符串的折行方式略有不同，但解析出来的数据是一样的
+try:
+    from yaml import CSafeDumper as Dumper, CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeDumper as Dumper, SafeLoader as Loader
+
+# 序列化选项: key排序，保证同样的数据总是输出同样的字节
+dump_options = {
+    'sort_keys': True,
+    'default_flow_style': False,
+}
+
+def dump_yaml(data):
+    '''
+    确定性的yaml序列化
+    :param data 资源数据
+    '''
+    return yaml.dump(data, Dumper=Dumper, **dump_options)
+
+# 多文档yaml的文档分隔符
+doc_separator = b'---\n'
+
+def load_yaml_file(path):
+    '''
+    读yaml文件中的所有文档
+    :param path 文件路径
+    :return 文档列表，忽略空文档
+    '''
+    with open(path, 'r', encoding="utf-8") as f:
+        return [doc for doc in yaml.load_all(f, Loader=Loader) if doc is not None]
+
+def load_yaml_doc(f, offset, length):
+    '''
+    读yaml文件中指定位置的单个文档
+    :param f 以二进制模式打开的文件
+    :param offset 文档的字节偏移
+    :param length 文档的字节长度
+    '''
+    f.seek(offset)
+    return yaml.load(f.read(length), Loader=Loader)
+
+def scan_yaml_spans(content):
+    '''
+    扫描多文档yaml中每个文档的位置，用于没有索引的资源文件
+    :param content 文件内容(bytes)
+    :return 文档位置[(字节偏移, 字节长度)]
+    '''
+    spans = []
+    start = pos = 0
+    for line in content.splitlines(keepends=True):
+        if line.rstrip(b'\r\n') == b'---' or line.startswith(b'--- '):
+            if pos > start:
+                spans.append((start, pos - start))
+            start = pos + len(line)
+        pos += len(line)
+    if pos > start:
+        spans.append((start, pos - start))
+    return spans
+
+def write_yaml_file(path, data, spans = None):
+    '''
+    将资源流式写到yaml文件: 多个资源逐个序列化到文件，不用先在内存中拼接
+        内容有变化时才替换旧文件
+    :param path 文件路径
+    :param data 资源数据，list类型表示多个资源
+    :param spans 用于收集每个资源在文件中的位置[(字节偏移, 字节长度)]，供输出索引用
+    :return 是否写了文件
+    '''
+    tmp = build_tmp_path(path)
+    try:
+        with open(tmp, 'wb') as f:
+            if isinstance(data, str):
+                f.write(data.encode('utf-8'))
+            else:
+                docs = data if isinstance(data, list) else [data] # list表示多个资源
+                for i, doc in enumerate(docs):
+                    if i > 0: # 与yaml.dump_all()一样，用---分隔文档
+                        f.write(doc_separator)
+                    content = dump_yaml(doc).encode('utf-8')
+                    if spans is not None:
+                        spans.append((f.tell(), len(content)))
+                    f.write(content)
+    except BaseException: # 序列化失败(如资源中有不能序列化的对象)，不能在输出目录留下临时文件
+        os.remove(tmp)
+        raise
+    return replace_if_changed(tmp, path)
+
+def write_file_if_changed(path, content):
+    '''
+    内容有变化时才写文件，以免无谓地改变文件的修改时间
+    :param path 文件路径
+    :param content 文件内容
+    :return 是否写了文件
+    '''
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    tmp = build_tmp_path(path)
+    with open(tmp, 'wb') as f:
+        f.write(content)
+    return replace_if_changed(tmp, path)
+
+# 构建同目录下的临时文件路径，用于原子写
+def build_tmp_path(path):
+    return f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+
+def replace_if_changed(tmp, path):
+    '''
+    用临时文件替换旧文件: 内容相同则删掉临时文件，否则改名覆盖旧文件(原子操作)
+    :param tmp 临时文件
+    :param path 旧文件
+    :return 是否替换了
+    '''
+    if is_same_content(tmp, path):
+        os.remove(tmp)
+        return False
+    os.replace(tmp, path)
+    return True
+
+# 对比2个文件的内容是否相同: 先比大小，再比内容
+def is_same_content(file1, file2):
+    try:
+        if os.path.getsize(file1) != os.path.getsize(file2):
+            return False
+    except OSError: # 文件不存在
+        return False
+    with open(file1, 'rb') as f1, open(file2, 'rb') as f2:
+        return f1.read() == f2.read()
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''
+渲染性能的基准测试: 渲染 example/ 下的每个示例，以及合成的大规模示例(默认1000个app)
+    统计墙钟时间、各动作的耗时、峰值内存(RSS)、生成的文件数与字节数
+    每个场景在独立的子进程中执行，以便单独统计其峰值内存；只渲染资源文件，不需要k8s集群
+    可将结果保存为基线，下次与基线对比，有回归则退出码为1，用作CI的性能关卡
+用法:
+    python benchmarks/bench_render.py                       # 跑所有场景
+    python benchmarks/bench_render.py -k kafka -k synthetic # 只跑名字包含指定关键字的场景
+    python benchmarks/bench_render.py --save-baseline       # 跑完保存为基线
+    python benchmarks/bench_render.py --check               # 跑完与基线对比
+'''
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+
+default_baseline = os.path.join(root_dir, 'benchmarks', 'baseline.json')
+
+# ---------------- 场景 ----------------
+def list_example_scenarios():
+    '''
+    example/ 下的每个目录为一个场景: 目录下有*.yml则渲染该目录，否则渲染其k8s子目录(如elk)
+    :return [(场景名, 步骤文件或目录)]
+    '''
+    ret = []
+    for dir in sorted(glob.glob(os.path.join(root_dir, 'example', '*'))):
+        if not os.path.isdir(dir):
+            continue
+        if not glob.glob(os.path.join(dir, '*.yml')):
+            dir = os.path.join(dir, 'k8s')
+            if not os.path.isdir(dir):
+                continue
+        name = os.path.relpath(dir, os.path.join(root_dir, 'example')).replace(os.sep, '/')
+        ret.append((name, dir))
+    return ret
+
+def gen_synthetic(dir, napps, apps_per_file = 50):
+    '''
+    生成合成的步骤文件: napps个app，每个app有配置+容器+服务，每10个app中有1个用sts部署，最后一个文件的网关app引用前20个app的端口
+    :param dir 输出目录
+    :param napps app数
+    :param apps_per_file 每个步骤文件的app数
+    '''
+    os.makedirs(dir, exist_ok=True)
+    for start in range(0, napps, apps_per_file):
+        lines = []
+        for i in range(start, min(start + apps_per_file, napps)):
+            app = f"app{i:04d}"
+            deploy = '- sts: 1' if i % 10 == 9 else '- deploy: 2'
+            lines.append(f"""- app({app}):
+    - config:
+        key: value-{i}
+        log_level: info
+    - containers:
+        {app}:
+          image: nginx:1.25
+          env:
+            TZ: Asia/Shanghai
+            APP_NAME: $app
+            POD_IP: ${{ref_pod_field(status.podIP)}}
+          env_from:
+            - config
+          ports:
+            - 8080:80
+          volumes:
+            - config://:/etc/{app}
+          resources:
+            cpu: 0.01~0.1
+            memory: 50Mi~100Mi
+    {deploy}
+""")
+        with open(os.path.join(dir, f"{start // apps_per_file:03d}-apps.yml"), 'w', encoding='utf-8') as f:
+            f.write(''.join(lines))
+    # 网关: 跨步骤文件引用app端口
+    urls = ''.join(f"        http://synthetic.com/app{i:04d}: app{i:04d}:8080\n" for i in range(min(20, napps)))
+    with open(os.path.join(dir, '999-gateway.yml'), 'w', encoding='utf-8') as f:
+        f.write(f"- app(gateway):\n    - ingress:\n{urls}")
+
+# ---------------- 子进程: 执行单个场景 ----------------
+# 获得当前进程(含已结束的子进程)的峰值内存(MB)
+def get_peak_rss():
+    try:
+        import resource
+    except ImportError: # windows
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin': # mac单位是字节，linux是KB
+        rss /= 1024
+    return rss / 1024
+
+def run_scenario(path, rounds, jobs):
+    '''
+    执行单个场景: 渲染多轮，墙钟时间取最小值
+    :param path 步骤文件或目录
+    :param rounds 轮数
+    :param jobs 渲染的进程数
+    :return 结果dict
+    '''
+    from pyutilb.log import log
+    from K8sBoot.boot import Boot
+    from K8sBoot.profiler import Profiler
+    from K8sBoot.render_pool import RenderPool
+    log.setLevel('WARNING')
+    walls = []
+    actions = {}
+    for _ in range(rounds):
+        with tempfile.TemporaryDirectory() as output_dir:
+            start = time.perf_counter()
+            if jobs > 1:
+                pool = RenderPool(output_dir, jobs)
+                pool.run([path])
+                file_stat = pool.file_stat
+            else:
+                boot = Boot(output_dir)
+                profiler = Profiler() # 只用来统计动作耗时，不启用cProfile
+                profiler.attach(boot)
+                try:
+                    boot.run([path])
+                finally:
+                    profiler.stop()
+                file_stat = boot.file_stat
+                # 只保留最后一轮的动作耗时
+                actions = {stat.name: {'count': stat.count, 'time': stat.cum, 'self': stat.self} for stat in profiler.stats.values() if stat.kind == 'action' and stat.count}
+            walls.append(time.perf_counter() - start)
+            files = glob.glob(os.path.join(output_dir, '*.yml'))
+            nbytes = sum(os.path.getsize(file) for file in files)
+    return {
+        'wall': min(walls),
+        'rss': get_peak_rss(),
+        'files': len(files),
+        'bytes': nbytes,
+        'written': file_stat['written'],
+        'actions': actions,
+    }
+
+# 在子进程中执行场景，以便单独统计峰值内存
+# 子进程的当前目录为临时目录，以免pyutilb的boot.log写到仓库中
+def spawn_scenario(name, path, option):
+    cmd = [sys.executable, os.path.abspath(__file__), '--run', os.path.abspath(path), '-n', str(option.n), '--jobs', str(option.jobs)]
+    with tempfile.TemporaryDirectory() as cwd:
+        proc = subprocess.run(cmd, capture_output=True, text=True, cwd=cwd)
+    if proc.returncode != 0:
+        error = (proc.stderr.strip().splitlines() or ['unknown error'])[-1]
+        return {'error': error}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+# ---------------- 报告与基线 ----------------
+def print_report(results, verbose):
+    print(f"{'scenario':<22}{'wall(ms)':>10}{'rss(MB)':>10}{'files':>7}{'KB':>9}  slowest actions(ms, incl. children)")
+    total = {}
+    for name, ret in results.items():
+        if 'error' in ret:
+            print(f"{name:<22}  error: {ret['error']}")
+            continue
+        actions = sorted(ret['actions'].items(), key=lambda item: -item[1]['time'])
+        for action, stat in actions:
+            total.setdefault(action, [0, 0.0])
+            total[action][0] += stat['count']
+            total[action][1] += stat['time']
+        top = ', '.join(f"{action}={stat['time'] * 1000:.1f}" for action, stat in actions[:3])
+        rss = f"{ret['rss']:.1f}" if ret['rss'] is not None else '-'
+        print(f"{name:<22}{ret['wall'] * 1000:>10.1f}{rss:>10}{ret['files']:>7}{ret['bytes'] / 1024:>9.1f}  {top}")
+        if verbose:
+            for action, stat in actions:
+                print(f"    {action:<20}{stat['count']:>8}{stat['time'] * 1000:>10.1f}")
+    if total:
+        print('\nall scenarios, per action:')
+        print(f"    {'action':<20}{'count':>8}{'time(ms)':>10}")
+        for action, (count, cost) in sorted(total.items(), key=lambda item: -item[1][1]):
+            print(f"    {action:<20}{count:>8}{cost * 1000:>10.1f}")
+
+def check_baseline(results, baseline, option):
+    '''
+    与基线对比
+        墙钟时间: 超过基线的(1+tolerance)倍，且多出的时间超过slack毫秒(过滤小场景的抖动)，视为回归
+        峰值内存: 超过基线的(1+rss_tolerance)倍，视为回归
+        文件数: 与基线不同，视为渲染结果有变化
+    :return 回归的场景数
+    '''
+    print(f"\n{'scenario':<22}{'wall(ms)':>10}{'base':>10}{'delta':>8}{'rss(MB)':>10}{'base':>10}  status")
+    nfail = 0
+    for name, ret in results.items():
+        base = baseline.get(name)
+        if base is None or 'error' in ret:
+            print(f"{name:<22}  {'no baseline' if base is None else 'error'}")
+            continue
+        problems = []
+        delta = ret['wall'] / base['wall'] - 1
+        if delta > option.tolerance and (ret['wall'] - base['wall']) * 1000 > option.slack:
+            problems.append('slower')
+        if ret['rss'] and base['rss'] and ret['rss'] > base['rss'] * (1 + option.rss_tolerance):
+            problems.append('more memory')
+        if ret['files'] != base['files']:
+            problems.append(f"files {base['files']}->{ret['files']}")
+        if problems:
+            nfail += 1
+        rss = f"{ret['rss']:.1f}" if ret['rss'] is not None else '-'
+        base_rss = f"{base['rss']:.1f}" if base['rss'] is not None else '-'
+        print(f"{name:<22}{ret['wall'] * 1000:>10.1f}{base['wall'] * 1000:>10.1f}{delta:>+8.0%}{rss:>10}{base_rss:>10}  {', '.join(problems) or 'ok'}")
+    return nfail
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark rendering of example/ and synthetic apps')
+    parser.add_argument('-n', type=int, default=3, help='rounds per scenario, wall time is the minimum')
+    parser.add_argument('-k', action='append', help='only run scenarios whose name contains the keyword')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print per-action time of each scenario')
+    parser.add_argument('--apps', type=int, default=1000, help='number of apps in the synthetic scenario')
+    parser.add_argument('--jobs', type=int, default=1, help='number of processes to render, as K8sBoot --jobs')
+    parser.add_argument('--json', help='write results to the json file')
+    parser.add_argument('--baseline', default=default_baseline, help='baseline json file')
+    parser.add_argument('--save-baseline', action='store_true', help='save results as baseline')
+    parser.add_argument('--check', action='store_true', help='compare with baseline, exit 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed wall time regression ratio')
+    parser.add_argument('--slack', type=float, default=5, help='ignore wall time regression under the milliseconds')
+    parser.add_argument('--rss-tolerance', type=float, default=0.2, help='allowed peak rss regression ratio')
+    parser.add_argument('--run', help=argparse.SUPPRESS) # 子进程: 执行单个场景
+    option = parser.parse_args()
+
+    if option.run:
+        print(json.dumps(run_scenario(option.run, option.n, option.jobs)))
+        return
+
+    with tempfile.TemporaryDirectory() as synthetic_dir:
+        gen_synthetic(synthetic_dir, option.apps)
+        scenarios = list_example_scenarios() + [(f"synthetic-{option.apps}", synthetic_dir)]
+        if option.k:
+            scenarios = [(name, path) for name, path in scenarios if any(k in name for k in option.k)]
+        results = {}
+        for name, path in scenarios:
+            results[name] = spawn_scenario(name, path, option)
+            print(f"ran {name}", file=sys.stderr)
+
+    print_report(results, option.verbose)
+    if option.json:
+        with open(option.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if option.save_baseline:
+        baseline = {name: ret for name, ret in results.items() if 'error' not in ret}
+        with open(option.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print(f"\nbaseline saved to {option.baseline}")
+    if option.check:
+        if not os.path.exists(option.baseline):
+            raise Exception(f"Baseline not exist: {option.baseline}, run with --save-baseline first")
+        with open(option.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        nfail = check_baseline(results, baseline, option)
+        if nfail:
+            print(f"\n{nfail} scenarios regressed")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
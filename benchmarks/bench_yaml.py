@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+'''
+yaml序列化/解析的性能对比: 纯python版 vs libyaml的C版
+    先渲染 example/ 下所有步骤文件，再对生成的资源反复序列化与解析
+用法: python benchmarks/bench_yaml.py [-n 轮数]
+'''
+
+import argparse
+import glob
+import io
+import os
+import sys
+import tempfile
+import time
+import yaml
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+
+from pyutilb.log import log
+from K8sBoot.boot import Boot
+from K8sBoot.yaml_io import dump_options, load_yaml_file
+
+# 渲染所有example，返回生成的资源列表(每个文件一组)
+def render_examples(output_dir):
+    log.setLevel('WARNING')
+    groups = []
+    for i, step_file in enumerate(sorted(glob.glob(os.path.join(root_dir, 'example', '*', '*.yml')))):
+        out = os.path.join(output_dir, str(i))
+        try:
+            Boot(out).run([step_file])
+        except Exception as ex: # 如依赖其他步骤文件的 ingress/3gateway.yml
+            print(f"skip {os.path.relpath(step_file, root_dir)}: {ex}")
+            continue
+        for file in sorted(glob.glob(os.path.join(out, '*.yml'))):
+            groups.append(load_yaml_file(file))
+    return groups
+
+# 统计耗时
+def timeit(func, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        func()
+    return time.perf_counter() - start
+
+def bench(groups, n, Dumper, Loader):
+    # 序列化: 每组资源流式写到内存
+    def dump():
+        for docs in groups:
+            yaml.dump_all(docs, io.StringIO(), Dumper=Dumper, **dump_options)
+    texts = []
+    for docs in groups:
+        buf = io.StringIO()
+        yaml.dump_all(docs, buf, Dumper=Dumper, **dump_options)
+        texts.append(buf.getvalue())
+    # 解析
+    def load():
+        for txt in texts:
+            list(yaml.load_all(txt, Loader=Loader))
+    return timeit(dump, n), timeit(load, n)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark yaml dump/load on rendered example/')
+    parser.add_argument('-n', type=int, default=20, help='rounds')
+    option = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        groups = render_examples(output_dir)
+    ndocs = sum(len(docs) for docs in groups)
+    print(f"rendered {len(groups)} files, {ndocs} docs, {option.n} rounds")
+
+    impls = [('python', yaml.SafeDumper, yaml.SafeLoader)]
+    if yaml.__with_libyaml__:
+        impls.append(('libyaml', yaml.CSafeDumper, yaml.CSafeLoader))
+    else:
+        print("libyaml not available, only benchmark pure python implementation")
+    base = None
+    print(f"{'impl':<10}{'dump(s)':>10}{'load(s)':>10}{'dump x':>10}{'load x':>10}")
+    for name, Dumper, Loader in impls:
+        dump_cost, load_cost = bench(groups, option.n, Dumper, Loader)
+        if base is None:
+            base = (dump_cost, load_cost)
+        print(f"{name:<10}{dump_cost:>10.3f}{load_cost:>10.3f}{base[0] / dump_cost:>10.1f}{base[1] / load_cost:>10.1f}")
+
+if __name__ == '__main__':
+    main()